@@ -7,6 +7,12 @@ import logging  # Custom logger with easier to read colors and easier to control
 import sys
 import os
 import argparse  # Used to enable debug logging
+from urllib.parse import urlencode  # Query strings for paged requests
+
+try:
+    import msgpack  # Smaller and faster messages to the microservices that understand it
+except ImportError:
+    msgpack = None
 
 
 # TODO: When functions are done, improve docstring with more info
@@ -301,24 +307,23 @@ class Task(LoggingHandler):
         """Delete task from server
         :return: True if successful, False if not
         """
-        response = self.client.server.delete(f"tasks/{self.id}", "")
+        # Delete the task and unlink it from its parent and children in one request.
+        # Its attributes are deleted along with it
+        operations = [{"type": "delete", "path": f"tasks/{self.id}", "data": ""}]
+        if self.parent is not None:
+            id_list = [child.id for child in self.parent.children if child.id != self.id]
+            operations.append({"type": "put", "path": f"tasks/{self.parent.id}", "data": {"children": id_list}})
+        for child in self.children:
+            if not isinstance(child, int):
+                operations.append({"type": "put", "path": f"tasks/{child.id}", "data": {"parent": None}})
+        response = self.client.server.batch(operations)
         if response["code"] == 200:
-            for attr in self.attributes:
-                attr.remove()
-                del attr
+            self.attributes = []
             self.client.tasks.remove(self)
             if self.parent is not None:
                 self.parent.children = [child for child in self.parent.children if child.id != self.id]
-                id_list = [child.id for child in self.parent.children]
-                response = self.client.server.put(f"tasks/{self.parent.id}", {"children": id_list})
-                if response["code"] != 200:
-                    self.log.error(f"Error updating parent task: {response["code"]} : {response["message"]}")
-
             for child in self.children:
                 if not isinstance(child, int):
-                    response = self.client.server.put(f"tasks/{child.id}", {"parent": None})
-                    if response["code"] != 200:
-                        self.log.error(f"Error updating child task: {response["code"]} : {response["message"]}")
                     child.parent = None
             self.log.debug(f"Task deleted: {self}")
             return True
@@ -326,6 +331,43 @@ class Task(LoggingHandler):
             self.log.error(f"Error deleting task: {response["code"]} : {response["message"]}")
             return False
 
+    def matches(self, task: dict) -> bool:
+        """Check if the task already has the same data as a copy from the server
+        :param task: The task as the server has it. Parent and children are IDs
+        :return: True if nothing is different
+        """
+        parent = self.parent.id if isinstance(self.parent, Task) else self.parent
+        children = [child.id if isinstance(child, Task) else child for child in self.children]
+        return (self.name == task["name"] and self.date == task["date"] and self.description == task["description"]
+                and self.status == task["status"] and parent == task["parent"] and children == task["children"]
+                and [(attr.id, attr.value) for attr in self.attributes]
+                == [(attr["id"], attr["value"]) for attr in task["attributes"]])
+
+    def refresh(self, task: dict):
+        """Replace the data with a newer copy from the server, and rebuild the widgets for the task
+        :param task: The task as the server has it. Parent and children are IDs
+        """
+        self.name = task["name"]
+        self.date = task["date"]
+        self.description = task["description"]
+        self.status = task["status"]
+        self.attributes = [Attribute(self.client, self.theme, attr["id"], attr["name"], attr["value"])
+                           for attr in task["attributes"]]
+        self.parent = self.client.get_task(task["parent"]) if task["parent"] is not None else None
+        self.children = [self.client.get_task(child) for child in task["children"]]
+        self.children = [child for child in self.children if child is not None]
+        self.list_item["button"].destroy()
+        self.detail_view["frame"].destroy()
+        self.options_frame = None
+        self.assign_attributes()
+        self.list_item = self.build_list_item(self.client.task_container)
+        self.detail_view = self.build_detail_view(self.client.detail_container)
+        self.options_frame = ctk.CTkFrame(self.detail_view["frame"], bg_color=self.theme["darker"], fg_color=self.theme["darker"])
+        self.assign_attributes()
+        self.attribute_options = self.build_attribute_options(self.options_frame)
+        self.options_open = False
+        self.log.debug(f"Task refreshed from server: {self}")
+
     def toggle_active(self) -> str:
         """Toggle task status between active and complete
         :return: New status
@@ -636,16 +678,16 @@ class Task(LoggingHandler):
         :param value: Value to be used
         :return: Attribute if successful, None if not
         """
-        self.client.attribute_records = []
-        self.client.fetch_attributes()
-        attr_id = len(self.client.attribute_records)
-        new_attribute = Attribute(self.client, self.theme, attr_id, name, value, self)
-        # Add attribute to main list, and then to task.
-        attr_response = self.client.server.post(f"attributes", {"id": attr_id, "name": name})
-        task_response = self.client.server.post(f"tasks/{self.id}/attributes",
-                                                {"id": attr_id, "name": name, "value": value})
-
-        if task_response["code"] == 200 and attr_response["code"] == 200:
+        # Add attribute to main list, and then to task, using the ID the server picks for the new record
+        response = self.client.server.batch([
+            {"type": "post", "path": "attributes", "data": {"name": name}},
+            {"type": "post", "path": f"tasks/{self.id}/attributes", "data": {"id": "$0", "name": name, "value": value}}
+        ])
+
+        if response["code"] == 200:
+            attr_id = response["data"][0]["data"]["id"]
+            self.client.attribute_records.append(AttributeRecord(self.client, self.theme, attr_id, name))
+            new_attribute = Attribute(self.client, self.theme, attr_id, name, value, self)
             self.attributes.append(new_attribute)
             # Add label to task detail view
             new_attribute.label.grid(row=self.detail_view["attr_row"], column=0, columnspan=3, sticky="nsw", pady=10,
@@ -663,8 +705,7 @@ class Task(LoggingHandler):
             self.log.info(f"Attribute created and added to task {self.id}: {new_attribute}")
             return new_attribute
         else:
-            self.log.error(f"Adding attribute to list gave: {attr_response["code"]} : {attr_response["message"]}")
-            self.log.error(f"Adding attribute to task gave: {task_response["code"]} : {task_response["message"]}")
+            self.log.error(f"Error creating attribute: {response["code"]} : {response["message"]}")
             return None
 
     def add_attribute(self, attr_id: int, value: str) -> Attribute | None:
@@ -677,7 +718,7 @@ class Task(LoggingHandler):
         if attr_id in ids:
             self.log.warning(f"Attribute {attr_id} already exists in task {self.id}")
             return None
-        name = self.client.attribute_records[attr_id].name
+        name = self.client.get_attribute_record(attr_id).name
         response = self.client.server.post(f"tasks/{self.id}/attributes", {"id": attr_id, "name": name, "value": value})
         if response["code"] == 200:
             # Create new attribute
@@ -731,7 +772,7 @@ class Task(LoggingHandler):
             removed = attribute.remove()
 
             # Add back a record option
-            record = self.client.attribute_records[attr_id]
+            record = self.client.get_attribute_record(attr_id)
             record.build_record_option(self.options_frame, self)
             self.attribute_options["existing_row"] += 1
             record.record["frame"].grid(row=self.attribute_options["existing_row"], column=0, columnspan=3,
@@ -791,6 +832,10 @@ def stop_scroll(event, widget):
 class Client(LoggingHandler):
     """Client for the To-Do List Application. Inherits from LoggingHandler to allow a logger per class"""
 
+    sync_interval = 2000  # Milliseconds between checks for changes made by other clients
+    list_chunk = 20  # Tasks to show at a time while the task list is streamed in, about a screen's worth
+    export_interval = 500  # Milliseconds between checks on a running export
+
     def __init__(self, server, sort_server, theme_server, export_server, *args, **kwargs):
         """
         :param connection:
@@ -812,23 +857,68 @@ class Client(LoggingHandler):
         self.task_container = self.build_task_list_container()
         self.extra_space, self.detail_container = self.build_detail_container()
         self.help_page = None
+        self.revision = None  # Last revision of the server data that the UI has caught up with
+        self.list_stream = None  # The sorter stream the task list is still being filled from
+        self.exports = {}  # Job ID of each export that is running, to how far along it is
         self.log.info("Client created")
         self.build_initial_ui()
 
     def export_tasks(self):
-        self.export_server.socket.send_string("export")
-        response = json.loads(self.export_server.socket.recv_string())
+        """Start exporting the tasks. The export runs as a job on the exporter, which is checked on every
+        export_interval instead of waiting for it, so the UI keeps working while it runs
+        """
+        response = self.export_server.exchange({"type": "export", "format": "csv", "path": "../data.csv"})
         if response["code"] == 200:
-            self.log.info("Tasks exported")
+            job = response["data"]["job"]
+            self.log.info(f"Export {job} started")
+            self.exports[job] = 0.0
+            self.show_export_progress()
+            self.root.after(self.export_interval, self.check_export, job)
+        elif response["code"] == 409:
+            # The last export to the same file hasn't finished, and is already being checked on
+            self.log.info(f"Export {response["data"]["job"]} is still running")
         else:
             self.log.error(f"Error exporting tasks: {response["code"]} : {response["message"]}")
 
+    def check_export(self, job: int):
+        """See how an export is going, and check again later if it is still running
+        :param job: The ID of the export's job
+        """
+        response = self.export_server.exchange({"type": "status", "job": job})
+        if response["code"] != 200:
+            self.log.error(f"Error checking export {job}: {response["code"]} : {response["message"]}")
+            del self.exports[job]
+        elif response["data"]["state"] in ("queued", "running"):
+            self.exports[job] = response["data"]["progress"]
+            self.root.after(self.export_interval, self.check_export, job)
+        else:
+            del self.exports[job]
+            match response["data"]["state"]:
+                case "done":
+                    self.log.info(f"Tasks exported to {response["data"]["result"]["path"]}")
+                case "failed":
+                    self.log.error(f"Error exporting tasks: {response["data"]["error"]}")
+                case _:
+                    self.log.info(f"Export {job} cancelled")
+        self.show_export_progress()
+
+    def show_export_progress(self):
+        """Show how far along the exports that are running are on the export button"""
+        if not self.exports:
+            self.menu_bar["export"].configure(text="Export")
+        else:
+            # The one that is furthest behind, since that's how long until they're all done
+            self.menu_bar["export"].configure(text=f"Export {min(self.exports.values()):.0%}")
+
     def get_theme(self):
         """Get the theme from the server"""
-        choice = ""
-        with open("../microservice_B/data.json", "r") as file:
-            data = json.load(file)
-            choice = data["theme"]
+        choice = "default"
+        response = self.server.get("theme")
+        if response["code"] == 200:
+            choice = response["data"]
+        else:
+            self.log.error(f"Error getting theme: {response["code"]} : {response["message"]}")
+        self.theme_choice = choice
         if choice == "default":
             theme = {"font": "#FFFFFF", "font_alt": "#FFFFFF", "lighter": "gray20", "darker": "gray14", "accent": "royal blue"}
         elif choice == "random":
@@ -838,18 +928,19 @@ class Client(LoggingHandler):
         return theme
 
     def change_theme(self, choice):
-        """Change the theme in the Json File"""
-        with open("../microservice_B/data.json", "r") as file:
-            data = json.load(file)
-            data["theme"] = choice
-        with open("../microservice_B/data.json", "w") as file:
-            json.dump(data, file)
+        """Change the theme on the server, and restart to apply it"""
+        response = self.server.put("theme", choice)
+        if response["code"] != 200:
+            self.log.error(f"Error changing theme: {response["code"]} : {response["message"]}")
+            return
         self.log.info(f"Theme changed to {choice}")
+        self.restart()
+
+    def restart(self):
+        """Restart the application, which is how a new theme is applied"""
         python = sys.executable
         os.execl(python, python, *sys.argv)
 
-
-
     # Build default UI
     def build_initial_ui(self):
         """Build the initial UI for the application"""
@@ -858,8 +949,24 @@ class Client(LoggingHandler):
         #  > menu_bar [[menu_bar]]
         #  > task_container [[task_container]]
         #  > detail_container [[detail_container]]
+        # Get the revision first, so nothing that changes during the fetch can be missed by the next sync
+        self.revision = self.get_revision()
         self.fetch_attributes()
         self.fetch_tasks()
+        self.link_tasks()
+
+        self.build_task_list()
+        self.build_task_details()
+        self.help_page = self.build_help_page()
+        self.menu_bar = self.build_menu()
+        self.menu_bar["sf_menu"] = self.build_sf_menu()
+        self.log.info("Initial UI built")
+        self.root.update()
+        self.root.after(self.sync_interval, self.sync)
+        self.root.mainloop()
+
+    def link_tasks(self):
+        """Link fetched tasks to their parents and children, and rebuild the widgets that show them"""
         self.assign_children()
         for task in self.tasks:
             if task.parent is not None or len(task.children) > 0:
@@ -871,16 +978,6 @@ class Client(LoggingHandler):
                 child.grid_forget()
             task.attribute_options = task.build_attribute_options(task.options_frame)
 
-
-        self.build_task_list()
-        self.build_task_details()
-        self.help_page = self.build_help_page()
-        self.menu_bar = self.build_menu()
-        self.menu_bar["sf_menu"] = self.build_sf_menu()
-        self.log.info("Initial UI built")
-        self.root.update()
-        self.root.mainloop()
-
     def build_menu(self):
         """Create the menu bar and buttons on it.
         :return: tk Object for menu bar and all buttons.
@@ -940,6 +1037,7 @@ class Client(LoggingHandler):
             "menu_bar": menu_bar,
             "sort": sorting_button,
             "add": add_task_button,
+            "export": export_button,
             "help": help_button
         }
 
@@ -1242,32 +1340,65 @@ class Client(LoggingHandler):
         if self.task_container.winfo_children():
             for widget in self.task_container.winfo_children():
                 widget.grid_forget()
-        sorted_ids = []
-        filtered_ids = []
-        if self.sort["sort"] != "":
-            sorted_ids = self.sort_server.sort_tasks(self.sort["sort"], self.sort["order"], self.sort["attr"])
-        if self.filter["filter"] != "":
-            filtered_ids = self.sort_server.filter_tasks(self.filter["filter"], self.filter["value"],
-                                                         self.filter["attr"])
-        if self.sort["sort"] != "" and self.filter["filter"] != "":
-            sf_tasks = [self.get_task(i) for i in sorted_ids if i in filtered_ids]
-        elif self.sort["sort"] != "":
-            sf_tasks = [self.get_task(i) for i in sorted_ids if self.get_task(i) is not None]
-        elif self.filter["filter"] != "":
-            sf_tasks = [self.get_task(i) for i in filtered_ids if self.get_task(i) is not None]
+        if self.sort["sort"] != "" or self.filter["filter"] != "":
+            # Sort and filter in one request. Open tasks go first, unless the tasks are being sorted by status
+            predicate = None
+            if self.filter["filter"] != "":
+                value = self.filter["value"]
+                if self.filter["filter"] == "id" and value.isdigit():
+                    value = str(int(value) - 1)
+                predicate = {"field": self.filter["filter"], "attr": self.filter["attr"], "op": "eq", "value": value}
+            sort = []
+            if self.sort["sort"] != "status":
+                sort.append({"field": "status", "order": "desc"})
+            if self.sort["sort"] != "":
+                sort.append({"field": self.sort["sort"], "attr": self.sort["attr"], "order": self.sort["order"]})
+            # Ties stay in ID order, which a descending sort on its own would reverse
+            sort.append({"field": "id"})
+            # The first chunk is shown straight away, and the rest are added once it has been drawn
+            id_list, self.list_stream = self.sort_server.query_stream(predicate, sort, self.list_chunk)
+            tasks_by_id = {task.id: task for task in self.tasks}
+            sf_tasks = [tasks_by_id[i] for i in id_list if i in tasks_by_id]
+            tasks = sf_tasks
+            if self.list_stream is not None:
+                self.root.after_idle(self.build_more_tasks, self.list_stream, len(tasks))
         else:
+            self.list_stream = None
             sf_tasks = self.tasks
-
-        if self.sort["sort"] != "status":
             open_tasks = [task for task in sf_tasks if task.status == "open"]
             closed_tasks = [task for task in sf_tasks if task.status == "closed"]
             tasks = open_tasks + closed_tasks
-        else:
-            tasks = sf_tasks
-        for i, task in enumerate(tasks):
+        self.grid_tasks(tasks, 0)
+        self.log.info(f"Built {len(sf_tasks)} tasks in task list")
+
+    def build_more_tasks(self, stream: int, row: int):
+        """Add the next chunk of a task list that is being streamed from the sorter
+        :param stream: The stream the chunks come from
+        :param row: The row to put the first task of the chunk on
+        """
+        if stream != self.list_stream:
+            # The list has been built again since this was scheduled
+            return
+        id_list, self.list_stream = self.sort_server.more(stream)
+        if id_list is None:
+            # The tasks changed on the sorter partway through, so start the list again
+            self.build_task_list()
+            return
+        tasks_by_id = {task.id: task for task in self.tasks}
+        tasks = [tasks_by_id[i] for i in id_list if i in tasks_by_id]
+        self.grid_tasks(tasks, row)
+        if self.list_stream is not None:
+            self.root.after_idle(self.build_more_tasks, self.list_stream, row + len(tasks))
+        self.log.debug(f"Added {len(tasks)} more tasks to task list")
+
+    def grid_tasks(self, tasks: list, row: int):
+        """Show tasks in the task list, starting from a row
+        :param tasks: The tasks, in order
+        :param row: The row to put the first one on
+        """
+        for i, task in enumerate(tasks, start=row):
             task.list_item["button"].grid(row=i, column=0, sticky="nsw", pady=10, padx=10)
             self.task_container.rowconfigure(i, weight=1)
-        self.log.info(f"Built {len(sf_tasks)} tasks in task list")
 
     def build_task_details(self):
         """Grid all the task details on the right side of the screen"""
@@ -1302,8 +1433,13 @@ class Client(LoggingHandler):
         """Fetch all tasks from the server
         :return: True if successful, False if not
         """
-        response = self.server.get("tasks/all")
-        if response["code"] == 200:
+        # Fetched a page at a time, so no single reply has to hold every task
+        cursor = None
+        while True:
+            response = self.server.get("tasks/all", limit=500, cursor=cursor)
+            if response["code"] != 200:
+                self.log.error(f"Error fetching tasks: {response["code"]} : {response["message"]}")
+                return False
             for task in response["data"]:
                 attr_list = []
                 for attr in task["attributes"]:
@@ -1313,12 +1449,12 @@ class Client(LoggingHandler):
                 new_task.assign_attributes()
 
                 self.tasks.append(new_task)
+            cursor = response["cursor"]
+            if cursor is None:
+                break
 
-            self.log.info(f"Fetched {len(self.tasks)} tasks from server")
-            return True
-        else:
-            self.log.error(f"Error fetching tasks: {response["code"]} : {response["message"]}")
-            return False
+        self.log.info(f"Fetched {len(self.tasks)} tasks from server")
+        return True
 
     def fetch_attributes(self) -> bool:
         """Fetch all attributes from the server
@@ -1335,6 +1471,106 @@ class Client(LoggingHandler):
             self.log.error(f"Error fetching attributes: {response["code"]} : {response["message"]}")
             return False
 
+    def get_revision(self) -> int | None:
+        """Get the current revision of the server data
+        :return: The revision, or None if it couldn't be fetched
+        """
+        response = self.server.get("changes")
+        if response["code"] != 200:
+            self.log.error(f"Error getting revision: {response["code"]} : {response["message"]}")
+            return None
+        return response["data"]["revision"]
+
+    def sync(self):
+        """Pick up changes made by other clients since the last sync, and only update the tasks they touched.
+        Runs every sync_interval milliseconds
+        """
+        if self.revision is None:
+            self.reload_tasks()
+        else:
+            response = self.server.get(f"changes?since={self.revision}")
+            if response["code"] == 200:
+                self.apply_changes(response["data"])
+            elif response["code"] == 410:
+                self.log.warning(f"Changes since revision {self.revision} are gone, fetching everything again")
+                self.reload_tasks()
+            else:
+                self.log.error(f"Error getting changes: {response["code"]} : {response["message"]}")
+        self.root.after(self.sync_interval, self.sync)
+
+    def apply_changes(self, changes: dict):
+        """Update the UI with the records that changed on the server
+        :param changes: The changes from the server, with created and updated records, and deleted IDs
+        """
+        if "theme" in changes["updated"] and changes["updated"]["theme"] != self.theme_choice:
+            self.log.info(f"Theme changed to {changes["updated"]["theme"]} by another client")
+            self.restart()
+        records = {record.id: record for record in self.attribute_records}
+        for attr_id in changes["deleted"]["attributes"]:
+            if attr_id in records:
+                self.attribute_records.remove(records.pop(attr_id))
+        for attr in changes["created"]["attributes"] + changes["updated"]["attributes"]:
+            if attr["id"] not in records:
+                self.attribute_records.append(AttributeRecord(self, self.theme, attr["id"], attr["name"]))
+
+        tasks = {task.id: task for task in self.tasks}
+        changed = False
+        for task_id in changes["deleted"]["tasks"]:
+            task = tasks.pop(task_id, None)
+            if task is None:
+                continue
+            task.list_item["button"].destroy()
+            task.detail_view["frame"].destroy()
+            self.tasks.remove(task)
+            for other in self.tasks:
+                if other.parent is task:
+                    other.parent = None
+                other.children = [child for child in other.children if child is not task]
+            changed = True
+
+        # Make any new tasks first, so the links between them can be filled in after
+        updated = changes["created"]["tasks"] + changes["updated"]["tasks"]
+        for task in updated:
+            if task["id"] not in tasks:
+                tasks[task["id"]] = Task(self, self.theme, task["id"], task["name"], task["date"], [],
+                                         task["description"], task["status"])
+                self.tasks.append(tasks[task["id"]])
+                # Even with nothing more to fill in, it still has to be put in the list
+                changed = True
+        for task in updated:
+            current = tasks[task["id"]]
+            if current.matches(task):
+                continue
+            if current.editing or current.options_open:
+                # Don't throw away what the user is typing. Their save will overwrite it anyway
+                self.log.warning(f"Task {current.id} changed on the server while being edited")
+                continue
+            current.refresh(task)
+            changed = True
+
+        if changed:
+            self.build_task_list()
+            self.build_task_details()
+        self.log.debug(f"Synced from revision {self.revision} to {changes["revision"]}")
+        self.revision = changes["revision"]
+
+    def reload_tasks(self):
+        """Throw away every task and fetch them all again, for when the UI is too far behind to catch up"""
+        revision = self.get_revision()
+        if revision is None:
+            return
+        for task in self.tasks:
+            task.list_item["button"].destroy()
+            task.detail_view["frame"].destroy()
+        self.tasks = []
+        self.attribute_records = []
+        self.fetch_attributes()
+        self.fetch_tasks()
+        self.link_tasks()
+        self.build_task_list()
+        self.build_task_details()
+        self.revision = revision
+
     def assign_children(self):
         for task in self.tasks:
             child_list = []
@@ -1358,24 +1594,46 @@ class Client(LoggingHandler):
             self.log.error(f"Error getting task {n}")
             return None
 
-    def add_task(self):
+    def get_attribute_record(self, attr_id):
+        """Get the attribute record with ID attr_id
+        :param attr_id: ID of the attribute record to get
+        :return: Attribute record with that ID
+        """
+        record = next((record for record in self.attribute_records if record.id == attr_id), None)
+        if record is None:
+            self.log.error(f"Error getting attribute record {attr_id}")
+        return record
+
+    def add_task(self, parent=None):
         """Add a new task to the server and UI
+        :param parent: Task to add the new task to as a child, if any
         :return: The new task
         """
-        new_task = Task(self, self.theme, len(self.tasks), "New Task", "2024-01-01", [], "Description", "open")
-        response = self.server.post("tasks/all",
-                                    {"id": len(self.tasks), "name": "New Task", "date": "01/01/2024", "parent": None,
-                                     "children": [], "attributes": [], "description": "Description", "status": "open"})
+        new_data = {"name": "New Task", "date": "01/01/2024", "parent": None, "children": [], "attributes": [],
+                    "description": "Description", "status": "open"}
+        # The server picks the ID, so the task can only be built once it has answered
+        if parent is None:
+            response = self.server.post("tasks/all", new_data)
+        else:
+            # Link the child and parent in the same request as creating it
+            child_ids = [child.id for child in parent.children]
+            response = self.server.batch([
+                {"type": "post", "path": "tasks/all", "data": {**new_data, "parent": parent.id}},
+                {"type": "put", "path": f"tasks/{parent.id}", "data": {"children": child_ids + ["$0"]}}
+            ])
         if response["code"] != 200:
             self.log.error(f"Error adding new task: {response["code"]} : {response["message"]}")
             return response
+        task = response["data"] if parent is None else response["data"][0]["data"]
+        new_task = Task(self, self.theme, task["id"], task["name"], task["date"], [], task["description"],
+                        task["status"])
         self.tasks.append(new_task)
         new_task.assign_attributes()
         self.build_task_list()
         self.build_task_details()
         self.log.info(f"Added new task {new_task}")
-        self.change_task(len(self.tasks) - 1)
-        self.edit_task(len(self.tasks) - 1)
+        self.change_task(new_task.id)
+        self.edit_task(new_task.id)
         return new_task
 
     def edit_task(self, n):
@@ -1485,36 +1743,46 @@ class Client(LoggingHandler):
         :param id: ID of the parent task
         """
         parent = self.get_task(id)
-        child = self.add_task()
+        child = self.add_task(parent)
+        if not isinstance(child, Task):
+            self.log.error(f"Error adding child to parent {parent.id}: {child["code"]} : {child["message"]}")
+            return
         parent.children.append(child)
         child.parent = parent
-        child_ids = [child.id for child in parent.children]
-        response = self.server.put(f"tasks/{parent.id}", {"children": child_ids})
-        if response["code"] != 200:
-            self.log.error(
-                f"Error adding child {child.id} to parent {parent.id}: {response["code"]} : {response["message"]}")
-        response = self.server.put(f"tasks/{child.id}", {"parent": parent.id})
-        if response["code"] != 200:
-            self.log.error(f"Error adding parent {parent.id} to {child.id}: {response["code"]} : {response["message"]}")
         self.log.info(f"Added child {child.id} to parent {parent.id}")
 
 
 class Connection(LoggingHandler):
     """The ZMQ Socket Connection to the server"""
 
-    def __init__(self, port, *args, **kwargs):
+    def __init__(self, port, *args, encoding: str = "json", **kwargs):
+        """
+        :param port: The port of the service on localhost
+        :param encoding: How to encode messages. "json" sends plain JSON, which every service understands.
+        "msgpack" sends a header frame naming the encoding, and falls back to JSON if msgpack isn't installed
+        """
         super().__init__(*args, **kwargs)
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.REQ)
         self.socket.connect(f"tcp://localhost:{port}")
-        self.log.info(f"Connection created to service at localhost:{port}")
+        self.encoding = encoding if encoding != "msgpack" or msgpack is not None else "json"
+        self.log.info(f"Connection created to service at localhost:{port} using {self.encoding}")
 
-    def get(self, path: str) -> dict:
+    def get(self, path: str, fields: list[str] = None, offset: int = None, limit: int = None,
+            cursor: int = None) -> dict:
         """Get data from server
         :param path: The path to the data to be accessed. Format will be [tasks|attributes]/[all|id]
-        :return: Response from server
+        :param fields: For tasks/all, the fields to include in each task
+        :param offset: For tasks/all, how many tasks to skip
+        :param limit: For tasks/all, the most tasks to return
+        :param cursor: For tasks/all, the cursor from the previous page. The next page starts after it
+        :return: Response from server. A page of tasks will also have the cursor for the next page,
+        which is None on the last page
         """
-        return self.request("get", path)
+        params = {"fields": ",".join(fields) if fields is not None else None,
+                  "offset": offset, "limit": limit, "cursor": cursor}
+        query = urlencode({name: value for name, value in params.items() if value is not None}, safe=",")
+        return self.request("get", f"{path}?{query}" if query else path)
 
     def post(self, path: str, data: dict) -> dict:
         """Add data to server
@@ -1540,6 +1808,14 @@ class Connection(LoggingHandler):
         """
         return self.request("delete", path, data)
 
+    def batch(self, operations: list[dict]) -> dict:
+        """Send several requests to the server in one go. They are applied in order, and either all succeed or none do
+        :param operations: The requests to send, each with a type, path, and data. "$n" in a path, or as an id,
+        parent, or child in the data, refers to the ID returned by operation n
+        :return: Response from server. The data will have one response per operation
+        """
+        return self.request("batch", "", operations)
+
     def request(self, action: str, path: str, data: dict = None) -> dict:
         """Send a request to server and return response
         :param action: The type of request to be made. Can be "get", "post", "put", or "delete"
@@ -1553,12 +1829,26 @@ class Connection(LoggingHandler):
             "data": data
         }
 
-        self.socket.send_string(json.dumps(payload))
-        response = json.loads(self.socket.recv_string())
+        response = self.exchange(payload)
         print(f"Action {action} to {path} gave response: {response}")
 
         return response
 
+    def exchange(self, payload: dict) -> dict:
+        """Send a message to the service and wait for its reply
+        :param payload: The message to send
+        :return: The reply, decoded the same way it was sent
+        """
+        if self.encoding == "msgpack":
+            self.socket.send_multipart([b"msgpack", msgpack.packb(payload)])
+            frames = self.socket.recv_multipart()
+            if len(frames) == 2:
+                return msgpack.unpackb(frames[1])
+            # The service didn't understand the header, and answered in plain JSON
+            return json.loads(frames[0])
+        self.socket.send_string(json.dumps(payload))
+        return json.loads(self.socket.recv_string())
+
     def sort_tasks(self, sort: str, order: str, attr: bool) -> list:
         """Sort the tasks based on a given attribute
         :param sort: The attribute to sort by
@@ -1570,8 +1860,7 @@ class Connection(LoggingHandler):
             "order": order,
             "attr": attr
         }
-        self.socket.send_string(json.dumps(data))
-        response = json.loads(self.socket.recv_string())
+        response = self.exchange(data)
         return response["data"]
 
     def filter_tasks(self, filter: str, value: str, attr: bool) -> list:
@@ -1587,10 +1876,41 @@ class Connection(LoggingHandler):
             "filter": value,
             "attr": attr
         }
-        self.socket.send_string(json.dumps(data))
-        response = json.loads(self.socket.recv_string())
+        response = self.exchange(data)
         return response["data"]
 
+    def query_stream(self, filter: dict = None, sort: list[dict] = None, chunk: int = 20) -> tuple[list, int | None]:
+        """Filter and sort the tasks, and get the IDs a chunk at a time
+        :param filter: Which tasks to include. Either {"field", "attr", "op", "value"}, where op is "eq", "lt", "le",
+        "gt", "ge", "prefix", or "contains", or {"and": [...]} or {"or": [...]} of other filters. None for all tasks
+        :param sort: The fields or attributes to sort by, each a {"field", "attr", "order"}
+        :param chunk: How many IDs to get at a time
+        :return: The first chunk of IDs, and the stream to get the rest from, or None if that was all of them
+        """
+        data = {
+            "type": "query",
+            "filter": filter,
+            "sort": sort,
+            "stream": chunk
+        }
+        response = self.exchange(data)
+        if response["code"] != 200:
+            self.log.error(f"Error querying tasks: {response["code"]} : {response["message"]}")
+            return [], None
+        return response["data"], response["stream"]
+
+    def more(self, stream: int) -> tuple[list | None, int | None]:
+        """Get the next chunk of IDs from a stream
+        :param stream: The stream, from query_stream
+        :return: The IDs, and the stream to keep getting them from, or None if that was the last chunk.
+        The IDs are None if the stream has ended early, because the tasks changed
+        """
+        response = self.exchange({"type": "more", "stream": stream})
+        if response["code"] != 200:
+            self.log.warning(f"Stream {stream} ended: {response["code"]} : {response["message"]}")
+            return None, None
+        return response["data"], response["stream"]
+
     def get_theme(self, type: str) -> dict:
         """Get the theme for the application
         :param type: The type of theme to get. Can be "colors", "animal" or "nature"
@@ -1600,10 +1920,9 @@ class Connection(LoggingHandler):
             "type": "theme",
             "theme": type
         }
-        self.socket.send_string(json.dumps(data))
-        response = json.loads(self.socket.recv_string())
+        response = self.exchange(data)
         self.log.debug(f"Got theme: {response}")
         return response[type]
 
 
-c = Client(Connection(5555), Connection(6666), Connection(3000), Connection(7777))
+c = Client(Connection(5555, encoding="msgpack"), Connection(6666, encoding="msgpack"), Connection(3000), Connection(7777))
@@ -0,0 +1,67 @@
+import collections
+from store import Store
+
+
+class ChangeFeed:
+    """Remembers which records the recent revisions changed, so a client can catch up on just those,
+    instead of fetching everything again. Only the last `size` revisions are kept.
+    """
+
+    def __init__(self, revision: int, size: int = 1000):
+        """
+        :param revision: The revision the store is at when the server starts
+        :param size: How many revisions to remember
+        """
+        self.revision = revision
+        self.oldest = revision  # Every change after this revision is still in the feed
+        self.size = size
+        # (revision, [(kind, id, action)]) for each revision, oldest first
+        self.entries: collections.deque[tuple[int, list[tuple[str, int | None, str]]]] = collections.deque()
+
+    def add(self, revision: int, changes: list[tuple[str, int | None, str]]):
+        """Remember what a revision changed
+        :param revision: The revision the store is at after the change
+        :param changes: What changed, as (kind, id, action). Kind is "tasks", "attributes", or "theme",
+        and action is "created", "updated", or "deleted"
+        """
+        self.entries.append((revision, changes))
+        self.revision = revision
+        while len(self.entries) > self.size:
+            self.oldest = self.entries.popleft()[0]
+
+    def since(self, store: Store, revision: int) -> dict | None:
+        """Collect everything that changed after a revision, as the records are now
+        :param store: Where to get the current records from
+        :param revision: The last revision the client has seen
+        :return: The current revision, and the created and updated records and deleted IDs.
+        None if the changes since that revision are no longer kept, and the client has to fetch everything
+        """
+        if revision < self.oldest or revision > self.revision:
+            return None
+        changed = []
+        # The newest revisions are at the end, so only go back as far as the client needs
+        for entry_revision, changes in reversed(self.entries):
+            if entry_revision <= revision:
+                break
+            changed.append(changes)
+        actions: dict[tuple[str, int | None], str] = {}
+        for changes in reversed(changed):
+            for kind, record_id, action in changes:
+                if action == "updated" and actions.get((kind, record_id)) == "created":
+                    continue
+                actions[(kind, record_id)] = action
+
+        delta = {"revision": self.revision,
+                 "created": {"tasks": [], "attributes": []},
+                 "updated": {"tasks": [], "attributes": []},
+                 "deleted": {"tasks": [], "attributes": []}}
+        for (kind, record_id), action in actions.items():
+            if kind == "theme":
+                delta["updated"]["theme"] = store.get_theme()
+            elif action == "deleted":
+                delta["deleted"][kind].append(record_id)
+            elif kind == "tasks":
+                delta[action][kind].append(store.get_task(record_id))
+            else:
+                delta[action][kind].append(store.get_attribute(record_id))
+        return delta
@@ -1,20 +1,110 @@
 import zmq
-import json
+import argparse
+import signal
+import sys
+import threading
+import time
+import queue
+from urllib.parse import parse_qs
+import wire
+from changes import ChangeFeed
+from rwlock import RWLock
+from store import Store, DataStore, WalStore
+from sqlite_store import SqliteStore
+
+
+def resolve_references(operation: dict, results: list[dict]) -> dict:
+    """Fill in references to tasks or attributes made earlier in the same batch.
+    "$n" in the path, or as an id, parent, or child in the data, becomes the ID returned by operation n.
+    :param operation: The operation to fill in
+    :param results: Responses to the operations before it
+    :return: The operation with references replaced by IDs
+    """
+    def resolve(value):
+        if isinstance(value, str) and value.startswith("$") and value[1:].isdigit():
+            return results[int(value[1:])]["data"]["id"]
+        return value
+
+    path = "/".join(str(resolve(part)) for part in operation["path"].split("/"))
+    data = operation.get("data")
+    if isinstance(data, dict):
+        data = dict(data)
+        for key in ("id", "parent"):
+            if key in data:
+                data[key] = resolve(data[key])
+        if isinstance(data.get("children"), list):
+            data["children"] = [resolve(child) for child in data["children"]]
+    return {"type": operation["type"], "path": path, "data": data}
 
-context = zmq.Context()
-socket = context.socket(zmq.REP)
-print("Starting Server")
-socket.bind("tcp://*:5555")
 
-while True:
-    #  Wait for next request from client
-    message = str(socket.recv_string())
-    print(f"Received request: {message}")
-    message = json.loads(message)
+TASK_FIELDS = ["id", "name", "date", "parent", "children", "attributes", "description", "status"]
 
+
+def parse_page(query: str) -> dict:
+    """Read the paging options from the query string of a tasks/all request,
+    like fields=id,status&limit=200&cursor=41
+    :param query: The part of the path after the "?"
+    :return: The options to pass to Store.get_task_page
+    :raises ValueError: If an option isn't a number, or a field isn't one that tasks have
+    """
+    params = {name: values[-1] for name, values in parse_qs(query, strict_parsing=True).items()}
+    page = {"after": None, "offset": 0, "limit": None, "fields": None}
+    if "cursor" in params:
+        page["after"] = int(params["cursor"])
+    if "offset" in params:
+        page["offset"] = int(params["offset"])
+    if "limit" in params:
+        page["limit"] = int(params["limit"])
+    if page["offset"] < 0 or (page["limit"] is not None and page["limit"] < 0):
+        raise ValueError("offset and limit can't be negative")
+    if "fields" in params:
+        page["fields"] = params["fields"].split(",")
+        if any(field not in TASK_FIELDS for field in page["fields"]):
+            raise ValueError(f"Unknown field in {params['fields']}")
+    return page
+
+
+def changed_records(message: dict, response: dict) -> list[tuple[str, int | None, str]]:
+    """Work out which records a successful request changed
+    :param message: The request
+    :param response: The response it got, which has the IDs of anything it created
+    :return: What changed, as (kind, id, action) for ChangeFeed.add
+    """
+    if message["type"] == "batch":
+        changes = []
+        for operation, result in zip(message["data"], response["data"]):
+            operation = resolve_references(operation, response["data"])
+            changes += changed_records(operation, result)
+        return changes
+    path = message["path"].split("?")[0].split("/")
+    location = path[0]
+    spec = path[1] if len(path) > 1 else ""
+    key = path[2] if len(path) > 2 else ""
+    match message["type"], location:
+        case "get", _:
+            return []
+        case _, "theme":
+            return [("theme", None, "updated")]
+        case "post", _ if spec in ("all", ""):
+            return [(location, response["data"]["id"], "created")]
+        case "delete", _ if key == "":
+            return [(location, int(spec), "deleted")]
+        case _:
+            # Changing the attributes on a task changes the task
+            return [(location, int(spec), "updated")]
+
+
+def handle_request(store: Store, message: dict, feed: ChangeFeed = None) -> dict:
+    """Apply a request to the store
+    :param store: Where the server data is kept. Will be changed by post, put, and delete requests
+    :param message: The request, with a type, path, and data. A batch has a list of requests as its data,
+    which are applied in order, and either all kept or all undone
+    :param feed: The recent changes, for answering get changes requests
+    :return: The response to send back, with a code, message and data
+    """
     action = message["type"]
 
-    path = message["path"]
+    path, _, query = message["path"].partition("?")
     path = path.split("/")
     location = path[0]
     spec = path[1] if len(path) > 1 else ""
@@ -22,108 +112,140 @@ while True:
 
     incoming_data = message["data"]
 
-    file = open("data.json")
-    server_data = json.load(file)
     response = {"code": 200, "message": "", "data": None}
-    match action:
-        case "get":
-            print(f"get/{location}/{spec}")
-            match location:
-                case "tasks":
-                    match spec:
-                        case "all":
-                            response["data"] = server_data["tasks"]
-                        case spec if spec.isdigit():
-                            response["data"] = server_data["tasks"][int(spec)]
-                        case _:
-                            response["code"] = 400
-                case "attributes":
-                    match spec:
-                        case "all":
-                            response["data"] = server_data["attributes"]
-                        case spec if spec.isdigit():
-                            response["data"] = server_data["attributes"][int(spec)]
-
-        case "post":
-            print(f"post/{location}/{spec}/{key}")
-            match location:
-                case "tasks":
-                    match spec:
-                        case "all":
-                            server_data["tasks"].append(incoming_data)
-                        case spec if spec.isdigit():
-                            match key:
-                                case "attributes":
-                                    server_data["tasks"][int(spec)]["attributes"].append(incoming_data)
-                                case _:
-                                    response["code"] = 400
-                        case _:
-                            response["code"] = 400
-
-                case "attributes":
-                    server_data["attributes"].append(incoming_data)
-                case _:
-                    response["code"] = 400
-        case "put":
-            print(f"put/{location}/{spec}/{key}")
-            match location:
-                case "tasks":
-                    match spec:
-                        case "all":
-                            response["code"] = 404
-                        case spec if spec.isdigit():
-                            match key:
-                                case "attributes":
-                                    task_index = int(spec)
-                                    attribute_index = [i["id"] for i in server_data["tasks"][task_index]["attributes"]].index(incoming_data["id"])
-                                    server_data["tasks"][task_index]["attributes"][attribute_index].update(incoming_data)
-                                case "":
-                                    task_index = int(spec)
-                                    # Get the existing task
-                                    server_data["tasks"][task_index].update(incoming_data)
-                                case _:
+    try:
+        match action:
+            case "get":
+                print(f"get/{location}/{spec}")
+                pinned = parse_qs(query).get("revision")
+                match location:
+                    case _ if pinned is not None and pinned[-1] != str(store.revision):
+                        # The data has changed since the revision the client is reading at, like partway through pages
+                        response["code"] = 409
+                        response["revision"] = store.revision
+                    case "tasks":
+                        match spec:
+                            case "all" if query:
+                                try:
+                                    page = parse_page(query)
+                                except ValueError:
                                     response["code"] = 400
-                        case _:
-                            response["code"] = 400
-        case "delete":
-            print(f"delete/{location}/{spec}/{key}")
-            match location:
-                case "tasks":
-                    match spec:
-                        case "all":
-                            response["code"] = 405
-                        case spec if spec.isdigit():
-                            match key:
-                                case "attributes":
-                                    task_index = int(spec)
-                                    res = list(filter(lambda i: i['id'] != incoming_data["id"], server_data["tasks"][task_index]["attributes"]))
-                                    server_data["tasks"][task_index]["attributes"] = res
-                                case "":
-                                    task_index = int(spec)
-                                    del server_data["tasks"][task_index]
-                                    for task in range(task_index, len(server_data["tasks"])):
-                                        server_data["tasks"][task]["id"] -= 1
-                                        # Update children tasks
-                                        if server_data["tasks"][task]["parent"]:
-                                            server_data["tasks"][task]["parent"] -= 1
-                                    for task in server_data["tasks"]:
-                                        if len(task["children"]) > 0:
-                                            for child in task["children"]:
-                                                if child > task_index:
-                                                    task["children"][task["children"].index(child)] -= 1
-                        case _:
-                            response["code"] = 400
-                case "attributes":
-                    match spec:
-                        case "all":
-                            response["code"] = 405
-                        case spec if spec.isdigit():
-                            attribute_index = int(spec)
-                            del server_data["attributes"][attribute_index]
-                        case _:
-                            response["code"] = 400
-        case _:
-            response["code"] = 400
+                                else:
+                                    response["data"], response["cursor"] = store.get_task_page(**page)
+                                    response["revision"] = store.revision
+                            case "all":
+                                response["data"] = store.get_tasks()
+                            case spec if spec.isdigit():
+                                response["data"] = store.get_task(int(spec))
+                            case _:
+                                response["code"] = 400
+                    case "attributes":
+                        match spec:
+                            case "all":
+                                response["data"] = store.get_attributes()
+                            case spec if spec.isdigit():
+                                response["data"] = store.get_attribute(int(spec))
+                    case "theme":
+                        response["data"] = store.get_theme()
+                    case "changes" if feed is not None:
+                        params = parse_qs(query)
+                        since = int(params["since"][-1]) if "since" in params else feed.revision
+                        response["data"] = feed.since(store, since)
+                        if response["data"] is None:
+                            # Too far behind, so the client has to fetch everything again
+                            response["code"] = 410
+
+            case "post":
+                print(f"post/{location}/{spec}/{key}")
+                match location:
+                    case "tasks":
+                        match spec:
+                            case "all":
+                                response["data"] = store.add_task(incoming_data)
+                            case spec if spec.isdigit():
+                                match key:
+                                    case "attributes":
+                                        store.add_task_attribute(int(spec), incoming_data)
+                                    case _:
+                                        response["code"] = 400
+                            case _:
+                                response["code"] = 400
+
+                    case "attributes":
+                        response["data"] = store.add_attribute(incoming_data)
+                    case _:
+                        response["code"] = 400
+            case "put":
+                print(f"put/{location}/{spec}/{key}")
+                match location:
+                    case "theme":
+                        store.set_theme(incoming_data)
+                    case "tasks":
+                        match spec:
+                            case "all":
+                                response["code"] = 404
+                            case spec if spec.isdigit():
+                                match key:
+                                    case "attributes":
+                                        store.update_task_attribute(int(spec), incoming_data)
+                                    case "":
+                                        store.update_task(int(spec), incoming_data)
+                                    case _:
+                                        response["code"] = 400
+                            case _:
+                                response["code"] = 400
+            case "delete":
+                print(f"delete/{location}/{spec}/{key}")
+                match location:
+                    case "tasks":
+                        match spec:
+                            case "all":
+                                response["code"] = 405
+                            case spec if spec.isdigit():
+                                match key:
+                                    case "attributes":
+                                        store.delete_task_attribute(int(spec), incoming_data["id"])
+                                    case "":
+                                        store.delete_task(int(spec))
+                            case _:
+                                response["code"] = 400
+                    case "attributes":
+                        match spec:
+                            case "all":
+                                response["code"] = 405
+                            case spec if spec.isdigit():
+                                store.delete_attribute(int(spec))
+                            case _:
+                                response["code"] = 400
+            case "batch":
+                print(f"batch of {len(incoming_data)}")
+                response["data"] = []
+                store.begin_batch()
+                for operation in incoming_data:
+                    try:
+                        operation = resolve_references(operation, response["data"])
+                        if operation["type"] == "batch":
+                            raise ValueError("Batches can't be nested")
+                    except (IndexError, KeyError, TypeError, ValueError):
+                        result = {"code": 400, "message": "Bad Request", "data": None}
+                    else:
+                        result = handle_request(store, operation, feed)
+                    response["data"].append(result)
+                    if result["code"] != 200:
+                        # Undo everything before it too, so the batch is all or nothing
+                        store.cancel_batch()
+                        response["code"] = result["code"]
+                        break
+                else:
+                    store.end_batch()
+            case _:
+                response["code"] = 400
+    except (IndexError, KeyError, ValueError):
+        # The task or attribute being asked for doesn't exist
+        response["code"] = 404
+    except (AttributeError, TypeError):
+        # The data sent isn't the shape the request needs, like null instead of an object
+        response["code"] = 400
 
     match response["code"]:
         case 200:
@@ -134,14 +256,141 @@ while True:
             response["message"] = "Not Found"
         case 405:
             response["message"] = "Method Not Allowed"
+        case 409:
+            response["message"] = "Conflict"
+        case 410:
+            response["message"] = "Gone"
+
+    return response
+
+
+def handle_write(store: Store, message: dict, feed: ChangeFeed = None) -> dict:
+    """Answer a request while holding the write lock. A change is made like a batch of one, so if it fails
+    partway through, whatever it had already changed is undone and the data is left as it was
+    :return: The response to send back
+    """
+    if message["type"] in ("get", "batch"):
+        # Nothing to undo for a get, and batches already undo themselves
+        return handle_request(store, message, feed)
+    store.begin_batch()
+    try:
+        response = handle_request(store, message, feed)
+    except Exception:
+        store.cancel_batch()
+        raise
+    if response["code"] == 200:
+        store.end_batch()
+    else:
+        store.cancel_batch()
+    return response
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--flush-interval', type=float, default=1.0,
+                    help='Seconds to wait after a change before writing to disk')
+parser.add_argument('--flush-threshold', type=int, default=100,
+                    help='Number of changes that will force a write to disk')
+parser.add_argument('--storage', choices=["json", "wal", "sqlite"], default="json",
+                    help='How the data is stored. json rewrites data.json, wal appends changes to a write-ahead log '
+                         'that is folded into data.json, and sqlite keeps it in data.db (imported from data.json '
+                         'the first time). The flush interval and threshold control how often changes are written')
+parser.add_argument('--compact-every', type=int, default=1000,
+                    help='Number of log records that will start folding the log into data.json')
+parser.add_argument('--compact-interval', type=float, default=60.0,
+                    help='Seconds after which the log is folded into data.json, even if it is short')
+parser.add_argument('--workers', type=int, default=4,
+                    help='Number of threads answering requests')
+parser.add_argument('--changes-kept', type=int, default=1000,
+                    help='Number of recent revisions that clients can catch up on with get changes')
+parser.add_argument('--pub-port', type=int, default=None,
+                    help='Port to publish each change on, with a PUB socket. Off by default')
+args = parser.parse_args()
+
+match args.storage:
+    case "wal":
+        store = WalStore("data.json", handle_request, args.flush_interval, args.flush_threshold,
+                         args.compact_every, args.compact_interval)
+    case "sqlite":
+        store = SqliteStore("data.db", "data.json", args.flush_interval, args.flush_threshold)
+    case _:
+        store = DataStore("data.json", args.flush_interval, args.flush_threshold)
+feed = ChangeFeed(store.revision, args.changes_kept)
+published = queue.Queue() if args.pub_port is not None else None
+
+
+def worker(worker_id: int):
+    """Answer requests passed on from the frontend. Reads can run alongside each other,
+    but writes have the store to themselves.
+    :param worker_id: Number of the worker, used in logs
+    """
+    socket = context.socket(zmq.REP)
+    socket.connect("inproc://workers")
+    while True:
+        #  Wait for next request from client
+        frames = socket.recv_multipart()
+        try:
+            message, encoding = wire.decode(frames)
+        except ValueError as error:
+            socket.send_multipart(wire.encode({"code": 415, "message": str(error), "data": None}, None))
+            continue
+        print(f"Worker {worker_id} received request: {message}")
+
+        try:
+            if message["type"] == "get" and store.concurrent_reads:
+                with lock.read():
+                    response = handle_request(store, message, feed)
+                    # Encode while still holding the lock, since the data can point into the store
+                    reply = wire.encode(response, encoding)
+            else:
+                with lock.write():
+                    response = handle_write(store, message, feed)
+                    if message["type"] != "get" and response["code"] == 200:
+                        store.record(message)
+                        feed.add(store.revision, changed_records(message, response))
+                        if published is not None:
+                            published.put(wire.encode(feed.since(store, store.revision - 1), None))
+                    reply = wire.encode(response, encoding)
+        except Exception as error:
+            # The client is still waiting for a reply, and the worker has to carry on to answer the next request
+            print(f"Worker {worker_id} failed to answer {message}: {error!r}")
+            reply = wire.encode({"code": 500, "message": "Internal Server Error", "data": None}, encoding)
+        #  Send reply back to client, in the same encoding as the request
+        socket.send_multipart(reply)
+
+
+def publisher():
+    """Push each change out to subscribers as it happens. Runs on its own thread, since it owns the PUB socket"""
+    socket = context.socket(zmq.PUB)
+    socket.bind(f"tcp://*:{args.pub_port}")
+    while True:
+        socket.send_multipart([b"changes"] + published.get())
+
+
+lock = RWLock()
+context = zmq.Context()
+# Clients connect to the frontend like before, and their requests are shared out between the workers
+frontend = context.socket(zmq.ROUTER)
+backend = context.socket(zmq.DEALER)
+print("Starting Server")
+frontend.bind("tcp://*:5555")
+backend.bind("inproc://workers")
+for i in range(args.workers):
+    threading.Thread(target=worker, args=(i,), name=f"worker-{i}", daemon=True).start()
+threading.Thread(target=zmq.proxy, args=(frontend, backend), name="proxy", daemon=True).start()
+if published is not None:
+    threading.Thread(target=publisher, name="publisher", daemon=True).start()
+
+# Make sure a kill still goes through the finally block, so nothing is lost
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    server_data["tasks"] = sorted(server_data["tasks"], key=lambda i: i["id"])
-    for task in server_data["tasks"]:
-        if task["attributes"]:
-            task["attributes"] = sorted(task["attributes"], key=lambda i: i["id"])
-    server_data["attributes"] = sorted(server_data["attributes"], key=lambda i: i["id"])
-    file = open("data.json", "w")
-    json.dump(server_data, file, indent=4)
-    file.close()
-    #  Send reply back to client
-    socket.send_string(json.dumps(response))
+try:
+    while True:
+        # Wait until a flush is due
+        wait = store.time_until_flush()
+        time.sleep(wait / 1000 if wait is not None else store.flush_interval)
+        with lock.read():
+            store.maybe_flush()
+finally:
+    with lock.write():
+        store.close()
+    print("Stopping Server")
@@ -0,0 +1,301 @@
+import json
+import os
+import sqlite3
+from store import Store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    date TEXT NOT NULL DEFAULT '',
+    description TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT 'open'
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+CREATE INDEX IF NOT EXISTS tasks_date ON tasks (date);
+CREATE TABLE IF NOT EXISTS task_attributes (
+    task_id INTEGER NOT NULL,
+    attribute_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (task_id, attribute_id)
+);
+CREATE INDEX IF NOT EXISTS task_attributes_name_value ON task_attributes (name, value);
+CREATE TABLE IF NOT EXISTS attributes (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS task_edges (
+    parent_id INTEGER NOT NULL,
+    child_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (parent_id, child_id)
+);
+CREATE INDEX IF NOT EXISTS task_edges_child ON task_edges (child_id);
+"""
+
+TASK_COLUMNS = ["name", "date", "description", "status"]
+
+
+class SqliteStore(Store):
+    """Keeps the data in an SQLite database, with tables for tasks, their attributes, the attribute records,
+    and the links between parent and child tasks. Tasks are looked up by their ID through the primary key,
+    so nothing has to be loaded that the request doesn't ask for. New task and attribute IDs come from counters
+    in the settings table, so they are never reused.
+    Changes are committed in batches, using the same flush interval and threshold as the other stores.
+    """
+
+    # Reads share the one connection, and its open transaction, with the writes
+    concurrent_reads = False
+
+    def __init__(self, path: str, import_path: str = None, flush_interval: float = 1.0, flush_threshold: int = 100):
+        super().__init__(flush_interval, flush_threshold)
+        self.path = path
+        new_database = not os.path.exists(path)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        if new_database and import_path is not None and os.path.exists(import_path):
+            self.import_json(import_path)
+        row = self.connection.execute("SELECT value FROM settings WHERE key = 'revision'").fetchone()
+        self.revision = int(row["value"]) if row is not None else 0
+
+    def import_json(self, import_path: str):
+        """Fill a new database from a data.json file"""
+        with open(import_path) as file:
+            data = json.load(file)
+        self.set_theme(data["theme"])
+        for task in data["tasks"]:
+            self.insert_task(task)
+        next_task_id = data.get("next_task_id", max((task["id"] for task in data["tasks"]), default=-1) + 1)
+        self.set_setting("next_task_id", next_task_id)
+        for attribute in data["attributes"]:
+            self.insert_attribute(attribute)
+        next_attribute_id = data.get("next_attribute_id",
+                                     max((attribute["id"] for attribute in data["attributes"]), default=-1) + 1)
+        self.set_setting("next_attribute_id", next_attribute_id)
+        self.set_setting("revision", data.get("revision", 0))
+        self.connection.commit()
+        print(f"Imported {len(data['tasks'])} tasks from {import_path} into {self.path}")
+
+    # Tasks
+    def get_tasks(self) -> list[dict]:
+        return self.get_task_page()[0]
+
+    def get_task_page(self, after: int = None, offset: int = 0, limit: int = None,
+                      fields: list[str] = None) -> tuple[list[dict], int | None]:
+        # Ask for one extra row to find out if there is another page
+        rows = self.connection.execute("SELECT * FROM tasks WHERE id > ? ORDER BY id LIMIT ? OFFSET ?",
+                                       (-1 if after is None else after, -1 if limit is None else limit + 1, offset))
+        rows = rows.fetchall()
+        cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            cursor = rows[-1]["id"] if rows else None
+        tasks = {row["id"]: self.task_from_row(row) for row in rows}
+        if not tasks:
+            return [], cursor
+        # The page is a run of IDs, so everything linked to it can be found with a range on the indexes
+        first, last = rows[0]["id"], rows[-1]["id"]
+        if fields is None or "attributes" in fields:
+            for row in self.connection.execute("SELECT * FROM task_attributes WHERE task_id BETWEEN ? AND ? "
+                                               "ORDER BY task_id, attribute_id", (first, last)):
+                if row["task_id"] in tasks:
+                    tasks[row["task_id"]]["attributes"].append(self.attribute_from_row(row))
+        if fields is None or "children" in fields:
+            for row in self.connection.execute("SELECT * FROM task_edges WHERE parent_id BETWEEN ? AND ? "
+                                               "ORDER BY parent_id, position", (first, last)):
+                if row["parent_id"] in tasks:
+                    tasks[row["parent_id"]]["children"].append(row["child_id"])
+        if fields is None or "parent" in fields:
+            for row in self.connection.execute("SELECT * FROM task_edges WHERE child_id BETWEEN ? AND ?",
+                                               (first, last)):
+                if row["child_id"] in tasks:
+                    tasks[row["child_id"]]["parent"] = row["parent_id"]
+        page = list(tasks.values())
+        if fields is not None:
+            page = [{field: task[field] for field in fields} for task in page]
+        return page, cursor
+
+    def get_task(self, task_id: int) -> dict:
+        row = self.connection.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        if row is None:
+            raise KeyError(task_id)
+        task = self.task_from_row(row)
+        rows = self.connection.execute("SELECT * FROM task_attributes WHERE task_id = ? ORDER BY attribute_id",
+                                       (task_id,))
+        task["attributes"] = [self.attribute_from_row(row) for row in rows]
+        rows = self.connection.execute("SELECT child_id FROM task_edges WHERE parent_id = ? ORDER BY position",
+                                       (task_id,))
+        task["children"] = [row["child_id"] for row in rows]
+        row = self.connection.execute("SELECT parent_id FROM task_edges WHERE child_id = ?", (task_id,)).fetchone()
+        task["parent"] = row["parent_id"] if row is not None else None
+        return task
+
+    def add_task(self, task: dict) -> dict:
+        task_id = self.next_id("next_task_id", "tasks")
+        self.insert_task({**task, "id": task_id})
+        return self.get_task(task_id)
+
+    def insert_task(self, task: dict):
+        """Insert a task with the ID it already has"""
+        self.connection.execute("INSERT INTO tasks (id, name, date, description, status) VALUES (?, ?, ?, ?, ?)",
+                                (task["id"], task.get("name", ""), task.get("date", ""),
+                                 task.get("description", ""), task.get("status", "open")))
+        for attribute in task.get("attributes", []):
+            self.add_task_attribute(task["id"], attribute)
+        if task.get("children"):
+            self.set_children(task["id"], task["children"])
+        if task.get("parent") is not None:
+            self.set_parent(task["id"], task["parent"])
+
+    def update_task(self, task_id: int, data: dict):
+        self.get_row("tasks", task_id)
+        columns = [column for column in TASK_COLUMNS if column in data]
+        if columns:
+            assignments = ", ".join(f"{column} = ?" for column in columns)
+            self.connection.execute(f"UPDATE tasks SET {assignments} WHERE id = ?",
+                                    [data[column] for column in columns] + [task_id])
+        if "attributes" in data:
+            self.connection.execute("DELETE FROM task_attributes WHERE task_id = ?", (task_id,))
+            for attribute in data["attributes"]:
+                self.add_task_attribute(task_id, attribute)
+        if "children" in data:
+            self.set_children(task_id, data["children"])
+        if "parent" in data:
+            self.set_parent(task_id, data["parent"])
+
+    def delete_task(self, task_id: int):
+        self.get_row("tasks", task_id)
+        self.connection.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+        self.connection.execute("DELETE FROM task_attributes WHERE task_id = ?", (task_id,))
+        self.connection.execute("DELETE FROM task_edges WHERE parent_id = ? OR child_id = ?", (task_id, task_id))
+
+    def set_children(self, task_id: int, children: list[int]):
+        self.connection.execute("DELETE FROM task_edges WHERE parent_id = ?", (task_id,))
+        self.connection.executemany("INSERT OR REPLACE INTO task_edges (parent_id, child_id, position) VALUES (?, ?, ?)",
+                                    [(task_id, child, position) for position, child in enumerate(children)])
+
+    def set_parent(self, task_id: int, parent_id: int | None):
+        self.connection.execute("DELETE FROM task_edges WHERE child_id = ?", (task_id,))
+        if parent_id is not None:
+            self.connection.execute("INSERT INTO task_edges (parent_id, child_id, position) "
+                                    "SELECT ?, ?, COALESCE(MAX(position) + 1, 0) FROM task_edges WHERE parent_id = ?",
+                                    (parent_id, task_id, parent_id))
+
+    # Attributes on a task
+    def add_task_attribute(self, task_id: int, attribute: dict):
+        self.get_row("tasks", task_id)
+        self.connection.execute("INSERT OR REPLACE INTO task_attributes (task_id, attribute_id, name, value) "
+                                "VALUES (?, ?, ?, ?)",
+                                (task_id, attribute["id"], attribute["name"], attribute.get("value", "")))
+
+    def update_task_attribute(self, task_id: int, attribute: dict):
+        columns = [column for column in ["name", "value"] if column in attribute]
+        if not columns:
+            return
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        cursor = self.connection.execute(f"UPDATE task_attributes SET {assignments} "
+                                         "WHERE task_id = ? AND attribute_id = ?",
+                                         [attribute[column] for column in columns] + [task_id, attribute["id"]])
+        if cursor.rowcount == 0:
+            raise KeyError((task_id, attribute["id"]))
+
+    def delete_task_attribute(self, task_id: int, attribute_id: int):
+        self.get_row("tasks", task_id)
+        self.connection.execute("DELETE FROM task_attributes WHERE task_id = ? AND attribute_id = ?",
+                                (task_id, attribute_id))
+
+    # Attribute records
+    def get_attributes(self) -> list[dict]:
+        return [dict(row) for row in self.connection.execute("SELECT id, name FROM attributes ORDER BY id")]
+
+    def get_attribute(self, attribute_id: int) -> dict:
+        return dict(self.get_row("attributes", attribute_id))
+
+    def add_attribute(self, attribute: dict) -> dict:
+        attribute_id = self.next_id("next_attribute_id", "attributes")
+        self.insert_attribute({"id": attribute_id, "name": attribute.get("name", "")})
+        return self.get_attribute(attribute_id)
+
+    def insert_attribute(self, attribute: dict):
+        """Insert an attribute record with the ID it already has"""
+        self.connection.execute("INSERT INTO attributes (id, name) VALUES (?, ?)", (attribute["id"], attribute["name"]))
+
+    def delete_attribute(self, attribute_id: int):
+        self.get_row("attributes", attribute_id)
+        self.connection.execute("DELETE FROM attributes WHERE id = ?", (attribute_id,))
+
+    # Settings
+    def get_theme(self) -> str:
+        row = self.connection.execute("SELECT value FROM settings WHERE key = 'theme'").fetchone()
+        return row["value"] if row is not None else "default"
+
+    def set_theme(self, theme: str):
+        self.set_setting("theme", theme)
+
+    def set_setting(self, key: str, value):
+        self.connection.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+    # Batches
+    def begin_batch(self):
+        # A savepoint inside the transaction that is still waiting for the next flush. Every write is made in one,
+        # so the transaction is started first if there isn't one, or releasing the savepoint would commit it
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+        self.connection.execute("SAVEPOINT batch")
+
+    def end_batch(self):
+        self.connection.execute("RELEASE SAVEPOINT batch")
+
+    def cancel_batch(self):
+        self.connection.execute("ROLLBACK TO SAVEPOINT batch")
+        self.connection.execute("RELEASE SAVEPOINT batch")
+
+    # Persistence
+    def flush(self):
+        """Commit the changes made since the last flush"""
+        if not self.pending:
+            return
+        self.set_setting("revision", self.revision)
+        self.connection.commit()
+        super().flush()
+
+    def close(self):
+        super().close()
+        self.connection.close()
+
+    # Helpers
+    def next_id(self, key: str, table: str) -> int:
+        """Hand out the next ID from a counter in the settings table"""
+        row = self.connection.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            next_id = int(row["value"])
+        else:
+            next_id = self.connection.execute(f"SELECT COALESCE(MAX(id) + 1, 0) FROM {table}").fetchone()[0]
+        self.set_setting(key, next_id + 1)
+        return next_id
+
+    def get_row(self, table: str, row_id: int) -> sqlite3.Row:
+        """Get a row by its ID
+        :raises KeyError: If there is no row with that ID
+        """
+        row = self.connection.execute(f"SELECT * FROM {table} WHERE id = ?", (row_id,)).fetchone()
+        if row is None:
+            raise KeyError(row_id)
+        return row
+
+    @staticmethod
+    def task_from_row(row: sqlite3.Row) -> dict:
+        return {"id": row["id"], "name": row["name"], "date": row["date"], "parent": None, "children": [],
+                "attributes": [], "description": row["description"], "status": row["status"]}
+
+    @staticmethod
+    def attribute_from_row(row: sqlite3.Row) -> dict:
+        return {"id": row["attribute_id"], "name": row["name"], "value": row["value"]}
@@ -0,0 +1,465 @@
+import bisect
+import copy
+import json
+import os
+import threading
+import time
+
+
+class Store:
+    """Where the server keeps its data. The request handler only talks to the data through these methods,
+    so the way it is stored can be swapped out.
+    Changes are batched, and written either after flush_interval seconds or once flush_threshold changes have built up.
+    """
+
+    # Whether reads can safely run at the same time as each other
+    concurrent_reads = True
+
+    def __init__(self, flush_interval: float = 1.0, flush_threshold: int = 100):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.pending = 0  # Changes made since the last flush
+        self.last_flush = time.monotonic()
+        self.revision = 0  # Goes up by one with every change, and is saved with the data
+
+    # Tasks
+    def get_tasks(self) -> list[dict]:
+        raise NotImplementedError
+
+    def get_task_page(self, after: int = None, offset: int = 0, limit: int = None,
+                      fields: list[str] = None) -> tuple[list[dict], int | None]:
+        """Get a page of tasks, in ID order
+        :param after: Only include tasks with a higher ID than this. This is the cursor from the previous page
+        :param offset: How many tasks to skip, after the cursor
+        :param limit: The most tasks to return, or None for all of them
+        :param fields: The fields to include in each task, or None for all of them
+        :return: The tasks, and the cursor for the next page, or None if this is the last page
+        """
+        raise NotImplementedError
+
+    def get_task(self, task_id: int) -> dict:
+        raise NotImplementedError
+
+    def add_task(self, task: dict) -> dict:
+        """Add a task, giving it the next free ID
+        :return: The task as it was stored, including its ID
+        """
+        raise NotImplementedError
+
+    def update_task(self, task_id: int, data: dict):
+        raise NotImplementedError
+
+    def delete_task(self, task_id: int):
+        raise NotImplementedError
+
+    # Attributes on a task
+    def add_task_attribute(self, task_id: int, attribute: dict):
+        raise NotImplementedError
+
+    def update_task_attribute(self, task_id: int, attribute: dict):
+        raise NotImplementedError
+
+    def delete_task_attribute(self, task_id: int, attribute_id: int):
+        raise NotImplementedError
+
+    # Attribute records
+    def get_attributes(self) -> list[dict]:
+        raise NotImplementedError
+
+    def get_attribute(self, attribute_id: int) -> dict:
+        raise NotImplementedError
+
+    def add_attribute(self, attribute: dict) -> dict:
+        """Add an attribute record, giving it the next free ID
+        :return: The record as it was stored, including its ID
+        """
+        raise NotImplementedError
+
+    def delete_attribute(self, attribute_id: int):
+        raise NotImplementedError
+
+    # Settings
+    def get_theme(self) -> str:
+        raise NotImplementedError
+
+    def set_theme(self, theme: str):
+        raise NotImplementedError
+
+    # Batches
+    def begin_batch(self):
+        """Start a group of changes that will either all be kept, or all be undone"""
+        raise NotImplementedError
+
+    def end_batch(self):
+        """Keep the changes made since begin_batch"""
+        raise NotImplementedError
+
+    def cancel_batch(self):
+        """Undo the changes made since begin_batch"""
+        raise NotImplementedError
+
+    # Persistence
+    def record(self, message: dict):
+        """Record a change to the data. Flushes right away if enough changes have built up
+        :param message: The request that changed the data
+        """
+        self.revision += 1
+        self.pending += 1
+        if self.pending >= self.flush_threshold:
+            self.flush()
+
+    def time_until_flush(self) -> int | None:
+        """How long until the next timed flush is due
+        :return: Milliseconds until the flush, or None if there is nothing to write
+        """
+        if not self.pending:
+            return None
+        remaining = self.flush_interval - (time.monotonic() - self.last_flush)
+        return max(0, int(remaining * 1000))
+
+    def maybe_flush(self):
+        """Flush if there are changes, and the flush interval has passed"""
+        if self.pending and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write pending changes to disk"""
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        """Write anything that is still pending before the server stops"""
+        self.flush()
+
+
+class MemoryStore(Store):
+    """Keeps the data as the same JSON document that is saved in data.json.
+    Tasks, the attributes on each task, and the attribute records are all indexed by ID,
+    so they can be found, changed and deleted without touching anything else.
+    IDs are handed out by the store from counters, and are never reused.
+    """
+
+    def __init__(self, data: dict, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.data = data
+        # These are the only copies of the tasks and attribute records. The lists in data.json are rebuilt
+        # from them when saving
+        self.tasks: dict[int, dict] = {task["id"]: task for task in data.pop("tasks")}
+        self.attributes: dict[int, dict] = {attribute["id"]: attribute for attribute in data.pop("attributes")}
+        # (task ID, attribute ID) to the attribute in that task's list
+        self.task_attributes: dict[tuple[int, int], dict] = {}
+        # Task IDs in order, so a page can be found without going through every task before it
+        self.task_ids: list[int] = sorted(self.tasks)
+        for task in self.tasks.values():
+            self.index_attributes(task)
+        data.setdefault("next_task_id", max(self.tasks, default=-1) + 1)
+        data.setdefault("next_attribute_id", max(self.attributes, default=-1) + 1)
+        self.revision = data.pop("revision", 0)
+        self.undo = None  # What to put back if the current batch is cancelled
+
+    def document(self) -> dict:
+        """The data in the form it is saved in data.json"""
+        return {**self.data, "revision": self.revision, "tasks": list(self.tasks.values()),
+                "attributes": list(self.attributes.values())}
+
+    def get_tasks(self) -> list[dict]:
+        return list(self.tasks.values())
+
+    def get_task_page(self, after: int = None, offset: int = 0, limit: int = None,
+                      fields: list[str] = None) -> tuple[list[dict], int | None]:
+        start = offset if after is None else bisect.bisect_right(self.task_ids, after) + offset
+        end = len(self.task_ids) if limit is None else min(start + limit, len(self.task_ids))
+        page = [self.tasks[task_id] for task_id in self.task_ids[start:end]]
+        cursor = self.task_ids[end - 1] if start < end < len(self.task_ids) else None
+        if fields is not None:
+            page = [{field: task[field] for field in fields} for task in page]
+        return page, cursor
+
+    def get_task(self, task_id: int) -> dict:
+        return self.tasks[task_id]
+
+    def add_task(self, task: dict) -> dict:
+        self.check_attributes(task.get("attributes", []))
+        # The ID is only taken once nothing else can fail, so a failed request never uses one up,
+        # and replaying the log hands out the same IDs as before
+        task_id = self.data["next_task_id"]
+        new_task = {"id": task_id, "name": task.get("name", ""), "date": task.get("date", ""),
+                    "parent": task.get("parent"), "children": task.get("children", []),
+                    "attributes": task.get("attributes", []), "description": task.get("description", ""),
+                    "status": task.get("status", "open")}
+        self.data["next_task_id"] += 1
+        self.save_task(task_id)
+        self.tasks[task_id] = new_task
+        self.task_ids.append(task_id)  # IDs only ever go up, so this keeps the list in order
+        self.index_attributes(new_task)
+        return new_task
+
+    def update_task(self, task_id: int, data: dict):
+        if "attributes" in data:
+            self.check_attributes(data["attributes"])
+        self.save_task(task_id)
+        task = self.tasks[task_id]
+        if "attributes" in data:
+            self.unindex_attributes(task)
+        task.update({key: value for key, value in data.items() if key != "id"})
+        if "attributes" in data:
+            self.index_attributes(task)
+
+    def delete_task(self, task_id: int):
+        self.save_task(task_id)
+        self.unindex_attributes(self.tasks.pop(task_id))
+        del self.task_ids[bisect.bisect_left(self.task_ids, task_id)]
+
+    def add_task_attribute(self, task_id: int, attribute: dict):
+        self.save_task(task_id)
+        task = self.tasks[task_id]
+        existing = self.task_attributes.get((task_id, attribute["id"]))
+        if existing is not None:
+            existing.update(attribute)
+        else:
+            task["attributes"].append(attribute)
+            self.task_attributes[(task_id, attribute["id"])] = attribute
+
+    def update_task_attribute(self, task_id: int, attribute: dict):
+        self.save_task(task_id)
+        self.task_attributes[(task_id, attribute["id"])].update(attribute)
+
+    def delete_task_attribute(self, task_id: int, attribute_id: int):
+        self.save_task(task_id)
+        task = self.tasks[task_id]
+        attribute = self.task_attributes.pop((task_id, attribute_id), None)
+        if attribute is not None:
+            task["attributes"].remove(attribute)
+
+    @staticmethod
+    def check_attributes(attributes: list[dict]):
+        """Make sure a task's attributes can be indexed, before any of them are stored
+        :raises KeyError: If one doesn't have an ID
+        :raises TypeError: If they aren't a list of objects
+        """
+        for attribute in attributes:
+            if "id" not in attribute:
+                raise KeyError("id")
+
+    def index_attributes(self, task: dict):
+        for attribute in task["attributes"]:
+            self.task_attributes[(task["id"], attribute["id"])] = attribute
+
+    def unindex_attributes(self, task: dict):
+        for attribute in task["attributes"]:
+            self.task_attributes.pop((task["id"], attribute["id"]), None)
+
+    def get_attributes(self) -> list[dict]:
+        return list(self.attributes.values())
+
+    def get_attribute(self, attribute_id: int) -> dict:
+        return self.attributes[attribute_id]
+
+    def add_attribute(self, attribute: dict) -> dict:
+        attribute_id = self.data["next_attribute_id"]
+        new_attribute = {"id": attribute_id, "name": attribute.get("name", "")}
+        self.data["next_attribute_id"] += 1
+        self.save_attribute(attribute_id)
+        self.attributes[attribute_id] = new_attribute
+        return new_attribute
+
+    def delete_attribute(self, attribute_id: int):
+        self.save_attribute(attribute_id)
+        del self.attributes[attribute_id]
+
+    def get_theme(self) -> str:
+        return self.data["theme"]
+
+    def set_theme(self, theme: str):
+        self.data["theme"] = theme
+
+    def begin_batch(self):
+        # The counters and theme are small enough to copy whole. Tasks and attribute records are only copied
+        # the first time the batch touches them
+        self.undo = {"data": dict(self.data), "tasks": {}, "attributes": {}}
+
+    def end_batch(self):
+        self.undo = None
+
+    def cancel_batch(self):
+        undo, self.undo = self.undo, None
+        for task_id, task in undo["tasks"].items():
+            if task_id in self.tasks:
+                self.unindex_attributes(self.tasks.pop(task_id))
+            if task is not None:
+                self.tasks[task_id] = task
+                self.index_attributes(task)
+        for attribute_id, attribute in undo["attributes"].items():
+            self.attributes.pop(attribute_id, None)
+            if attribute is not None:
+                self.attributes[attribute_id] = attribute
+        # Anything put back went to the end of the dicts, so sort them back into ID order
+        self.tasks = dict(sorted(self.tasks.items()))
+        self.task_ids = list(self.tasks)
+        self.attributes = dict(sorted(self.attributes.items()))
+        self.data.clear()
+        self.data.update(undo["data"])
+
+    def save_task(self, task_id: int):
+        """Keep a copy of a task before the batch changes it for the first time"""
+        if self.undo is not None and task_id not in self.undo["tasks"]:
+            self.undo["tasks"][task_id] = copy.deepcopy(self.tasks.get(task_id))
+
+    def save_attribute(self, attribute_id: int):
+        """Keep a copy of an attribute record before the batch changes it for the first time"""
+        if self.undo is not None and attribute_id not in self.undo["attributes"]:
+            self.undo["attributes"][attribute_id] = copy.deepcopy(self.attributes.get(attribute_id))
+
+
+class DataStore(MemoryStore):
+    """Keeps the server data in memory, and only writes it back to disk when it has changed.
+    Writes go to a temp file that is renamed over the old one, so the file is never half written.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, flush_threshold: int = 100):
+        with open(path) as file:
+            data = json.load(file)
+        super().__init__(data, flush_interval, flush_threshold)
+        self.path = path
+
+    def flush(self):
+        """Write the data to disk"""
+        if not self.pending:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.document(), file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        print(f"Flushed {self.pending} changes to {self.path}")
+        super().flush()
+
+
+def replay_log(log_path: str, store: Store, apply, seq: int) -> int:
+    """Apply the records in a log file to a store, skipping any that are already part of it
+    :param log_path: The log file to read
+    :param store: The store to apply the records to
+    :param apply: Function that applies one request to the data
+    :param seq: Sequence number of the last record already in the data
+    :return: Sequence number of the last record applied
+    """
+    if not os.path.exists(log_path):
+        return seq
+    with open(log_path, "rb+") as file:
+        valid_length = 0
+        for line in file:
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                # Only the last record can be cut off, by a crash in the middle of writing it.
+                # Cut it off the file too, so new records don't get appended onto the end of it
+                print(f"Dropping incomplete record at the end of {log_path}")
+                file.truncate(valid_length)
+                break
+            valid_length += len(line)
+            if message["seq"] > seq:
+                apply(store, message)
+                store.revision += 1
+                seq = message["seq"]
+    return seq
+
+
+class WalStore(DataStore):
+    """Keeps the server data in memory, and appends each change to a write-ahead log instead of rewriting the file.
+    The log is synced to disk in groups, using the same interval and threshold as DataStore.
+    A background compactor folds the log back into the snapshot file once it gets long enough.
+    """
+
+    def __init__(self, path: str, apply, flush_interval: float = 1.0, flush_threshold: int = 100,
+                 compact_every: int = 1000, compact_interval: float = 60.0):
+        super().__init__(path, flush_interval, flush_threshold)
+        self.apply = apply
+        self.log_path = f"{os.path.splitext(path)[0]}.wal"
+        self.compacting_path = f"{self.log_path}.compacting"
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self.compactor = None
+
+        # Load the latest snapshot, and then replay the log tail on top of it
+        self.seq = self.data.pop("wal_seq", 0)
+        self.seq = replay_log(self.compacting_path, self, apply, self.seq)
+        self.seq = replay_log(self.log_path, self, apply, self.seq)
+        self.logged = 0  # Records in the active log
+        if os.path.exists(self.log_path):
+            with open(self.log_path) as file:
+                self.logged = sum(1 for _ in file)
+        self.log_file = open(self.log_path, "a")
+        self.last_compact = time.monotonic()
+        print(f"Recovered {self.path} up to log record {self.seq}")
+
+        # A compaction was cut off, so finish it before the log is rotated again
+        if os.path.exists(self.compacting_path):
+            self.start_compactor()
+
+    def record(self, message: dict):
+        """Append the change to the log. It is synced to disk with the next group
+        :param message: The request that changed the data
+        """
+        self.seq += 1
+        record = {"seq": self.seq, "type": message["type"], "path": message["path"], "data": message["data"]}
+        self.log_file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.logged += 1
+        super().record(message)
+
+    def flush(self):
+        """Sync the log to disk, and start a compaction if it has grown enough"""
+        if not self.pending:
+            return
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        Store.flush(self)
+        if self.logged >= self.compact_every or time.monotonic() - self.last_compact >= self.compact_interval:
+            self.compact()
+
+    def compact(self):
+        """Move the active log aside, and fold it into the snapshot in the background"""
+        if self.compactor is not None and self.compactor.is_alive():
+            return
+        if os.path.exists(self.compacting_path):
+            # The previous compaction never finished, so that log still has to be folded first
+            self.start_compactor()
+            return
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        self.log_file.close()
+        os.replace(self.log_path, self.compacting_path)
+        self.log_file = open(self.log_path, "a")
+        self.logged = 0
+        self.last_compact = time.monotonic()
+        self.start_compactor()
+
+    def start_compactor(self):
+        self.compactor = threading.Thread(target=self.fold, name="compactor")
+        self.compactor.start()
+
+    def fold(self):
+        """Build a new snapshot from the old one and the moved log. Runs on the compactor thread,
+        and only touches the files, so the server can keep going while it works.
+        """
+        with open(self.path) as file:
+            data = json.load(file)
+        seq = data.pop("wal_seq", 0)
+        snapshot = MemoryStore(data)
+        seq = replay_log(self.compacting_path, snapshot, self.apply, seq)
+        snapshot = {**snapshot.document(), "wal_seq": seq}
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(snapshot, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        os.remove(self.compacting_path)
+        print(f"Compacted log into {self.path} up to record {seq}")
+
+    def close(self):
+        """Sync the log, and wait for a running compaction to finish"""
+        self.flush()
+        self.log_file.close()
+        if self.compactor is not None:
+            self.compactor.join()
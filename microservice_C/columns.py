@@ -0,0 +1,145 @@
+import bisect
+from replica import bound
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def usable(count: int, threshold: int | None) -> bool:
+    """Check if a query over this many tasks should use the columns
+    :param count: How many tasks there are
+    :param threshold: The fewest tasks to use them for, or None to never use them
+    :return: True if numpy is installed and there are enough tasks
+    """
+    return np is not None and threshold is not None and count >= threshold
+
+
+class Columns:
+    """The tasks laid out as numpy arrays, one row per task in ID order, so filters and sorts work on whole
+    columns at once instead of going through the tasks one at a time.
+    Each field or attribute is turned into columns the first time it is used:
+    its values, dictionary encoded as a code per value, for equality and text filters,
+    and the rank of each task's sort key among all the distinct keys, for range filters and sorting.
+    The columns are a snapshot, so they have to be built again when the tasks change.
+    """
+
+    def __init__(self, tasks, sort_key, revision: int | None = None):
+        """
+        :param tasks: The tasks
+        :param sort_key: Function that gets the sort key of a task, like Replica.sort_key
+        :param revision: The revision of the tasks, to tell when the columns are out of date
+        """
+        self.tasks = sorted(tasks, key=lambda task: task["id"])
+        self.ids = np.fromiter((task["id"] for task in self.tasks), dtype=np.int64, count=len(self.tasks))
+        self.sort_key = sort_key
+        self.revision = revision
+        # (attr, field) to the code of each distinct value, and the row and value code of each value.
+        # A task can have an attribute more than once, so there can be more than one per row
+        self.values: dict[tuple[bool, str], tuple[dict[str, int], np.ndarray, np.ndarray]] = {}
+        # (attr, field) to the distinct sort keys in order, and the rank of each row's key among them.
+        # Rows without the attribute get a rank after all of them
+        self.ranks: dict[tuple[bool, str], tuple[list[tuple], np.ndarray]] = {}
+
+    def values_for(self, field: str, attr: bool) -> tuple[dict[str, int], np.ndarray, np.ndarray]:
+        """Get the dictionary encoded values of a field or attribute, building them the first time"""
+        if (attr, field) not in self.values:
+            codes = {}
+            rows, row_codes = [], []
+            for row, task in enumerate(self.tasks):
+                if attr:
+                    for attribute in task["attributes"]:
+                        if attribute["name"] == field:
+                            rows.append(row)
+                            row_codes.append(codes.setdefault(attribute["value"], len(codes)))
+                else:
+                    rows.append(row)
+                    row_codes.append(codes.setdefault(str(task[field]), len(codes)))
+            self.values[(attr, field)] = (codes, np.array(rows, dtype=np.int64), np.array(row_codes, dtype=np.int64))
+        return self.values[(attr, field)]
+
+    def ranks_for(self, field: str, attr: bool) -> tuple[list[tuple], np.ndarray]:
+        """Get the ranks of the sort keys of a field or attribute, building them the first time"""
+        if (attr, field) not in self.ranks:
+            keys = [self.sort_key(task, field, attr) for task in self.tasks]
+            distinct = sorted({key for key in keys if key is not None})
+            rank = {key: i for i, key in enumerate(distinct)}
+            ranks = np.fromiter((rank[key] if key is not None else len(distinct) for key in keys),
+                                dtype=np.int64, count=len(keys))
+            self.ranks[(attr, field)] = (distinct, ranks)
+        return self.ranks[(attr, field)]
+
+    def mask(self, predicate: dict) -> np.ndarray:
+        """Find the rows a filter matches, the same way as query.matches
+        :param predicate: The filter, which has already been checked
+        :return: A boolean array, True for each matching row
+        """
+        if "and" in predicate:
+            mask = np.ones(len(self.tasks), dtype=bool)
+            for part in predicate["and"]:
+                mask &= self.mask(part)
+            return mask
+        if "or" in predicate:
+            mask = np.zeros(len(self.tasks), dtype=bool)
+            for part in predicate["or"]:
+                mask |= self.mask(part)
+            return mask
+
+        field, attr, op = predicate["field"], predicate.get("attr", False), predicate["op"]
+        if op in ("eq", "prefix", "contains"):
+            codes, rows, row_codes = self.values_for(field, attr)
+            # Test each distinct value once, then pick out the rows with the ones that match
+            if op == "eq":
+                matching = [codes[predicate["value"]]] if predicate["value"] in codes else []
+            else:
+                test = str.startswith if op == "prefix" else str.__contains__
+                matching = [code for value, code in codes.items() if test(value, predicate["value"])]
+            mask = np.zeros(len(self.tasks), dtype=bool)
+            mask[rows[np.isin(row_codes, matching)]] = True
+            return mask
+
+        distinct, ranks = self.ranks_for(field, attr)
+        key = bound(predicate)
+        below = bisect.bisect_left(distinct, key)  # Ranks of keys less than it
+        up_to = bisect.bisect_right(distinct, key)  # Ranks of keys up to and including it
+        match op:
+            case "lt":
+                return ranks < below
+            case "le":
+                return ranks < up_to
+            case "gt":
+                return (ranks >= up_to) & (ranks < len(distinct))
+            case _:
+                return (ranks >= below) & (ranks < len(distinct))
+
+    def query(self, predicate: dict | None, sort: list[dict], count: int | None) -> np.ndarray:
+        """Filter and sort the tasks, giving the same order as query.order
+        :param predicate: The filter, or None for every task
+        :param sort: The keys to sort by
+        :param count: How many IDs are needed from the front, or None for all of them
+        :return: The IDs, in order
+        """
+        rows = np.flatnonzero(self.mask(predicate)) if predicate is not None else np.arange(len(self.tasks))
+        if not sort:
+            return self.ids[rows[:count]]
+
+        if len(sort) == 1:
+            # One number per row, ranked by key and then by ID, since rows are in ID order.
+            # A descending sort is the ascending one backwards, ties and tasks without the attribute included
+            distinct, ranks = self.ranks_for(sort[0]["field"], sort[0].get("attr", False))
+            combined = ranks[rows] * len(self.tasks) + rows
+            if sort[0].get("order") == "desc":
+                combined = -combined
+            if count is not None and count < len(rows):
+                # Only the first count rows, without sorting the rest
+                top = np.argpartition(combined, count)[:count]
+                return self.ids[rows[top[np.argsort(combined[top])]]]
+            return self.ids[rows[np.argsort(combined)]]
+
+        # lexsort sorts by its last array first, and the rows come first so ties stay in ID order
+        keys = [rows]
+        for key in reversed(sort):
+            ranks = self.ranks_for(key["field"], key.get("attr", False))[1][rows]
+            keys.append(-ranks if key.get("order") == "desc" else ranks)
+        return self.ids[rows[np.lexsort(keys)[:count]]]
@@ -0,0 +1,399 @@
+import bisect
+import collections
+import heapq
+import itertools
+import json
+from typing import Iterator
+import columns
+from replica import Replica, bound
+
+OPERATORS = ["eq", "lt", "le", "gt", "ge", "prefix", "contains"]
+
+
+def check(predicate: dict | None):
+    """Make sure a filter is one that can be run
+    :param predicate: {"and": [...]}, {"or": [...]}, or {"field", "attr", "op", "value"}. None matches every task
+    :raises ValueError: If it isn't
+    """
+    if predicate is None:
+        return
+    if "and" in predicate or "or" in predicate:
+        for part in predicate.get("and", predicate.get("or")):
+            check(part)
+        return
+    if predicate.get("op") not in OPERATORS:
+        raise ValueError(f"Unknown operator {predicate.get('op')}")
+    if not isinstance(predicate.get("value"), str):
+        raise ValueError("Values are compared as strings")
+    if not predicate.get("attr", False):
+        if predicate.get("field") not in Replica.fields:
+            raise ValueError(f"Unknown field {predicate.get('field')}")
+        if predicate["op"] in ("lt", "le", "gt", "ge") and predicate["field"] in ("id", "parent"):
+            int(predicate["value"])
+
+
+def select(replica: Replica, predicate: dict) -> set[int]:
+    """Find the IDs of the tasks a filter matches, using the replica's indexes
+    :param replica: The replica, which has to be up to date
+    :param predicate: The filter
+    :return: The IDs. Never change this set, since it can be one of the indexes
+    """
+    if "and" in predicate:
+        if not predicate["and"]:
+            return set(replica.tasks)
+        parts = sorted((select(replica, part) for part in predicate["and"]), key=len)
+        return parts[0].intersection(*parts[1:])
+    if "or" in predicate:
+        return set().union(*(select(replica, part) for part in predicate["or"]))
+
+    field, attr, op, value = predicate["field"], predicate.get("attr", False), predicate["op"], predicate["value"]
+    match op:
+        case "eq":
+            if attr:
+                return replica.attribute_index.get((field, value), set())
+            return replica.field_index[field].get(value, set())
+        case "prefix" | "contains":
+            # Go through the distinct values, rather than every task
+            test = str.startswith if op == "prefix" else str.__contains__
+            if attr:
+                keys = [key for key in replica.attribute_index if key[0] == field and test(key[1], value)]
+                return set().union(*(replica.attribute_index[key] for key in keys))
+            keys = [key for key in replica.field_index[field] if test(key, value)]
+            return set().union(*(replica.field_index[field][key] for key in keys))
+        case _:
+            order = replica.order_for(field, attr)
+            key = bound(predicate)
+            below = bisect.bisect_left(order, (key,))  # Everything less than the key
+            up_to = bisect.bisect_right(order, (key, float("inf")))  # Everything up to and including it
+            match op:
+                case "lt":
+                    entries = order[:below]
+                case "le":
+                    entries = order[:up_to]
+                case "gt":
+                    entries = order[up_to:]
+                case _:
+                    entries = order[below:]
+            return {task_id for _, task_id in entries}
+
+
+def matches(task: dict, predicate: dict) -> bool:
+    """Check a task against a filter directly, for when there is no replica to use"""
+    if "and" in predicate:
+        return all(matches(task, part) for part in predicate["and"])
+    if "or" in predicate:
+        return any(matches(task, part) for part in predicate["or"])
+
+    field, attr, op, value = predicate["field"], predicate.get("attr", False), predicate["op"], predicate["value"]
+    match op:
+        case "eq":
+            return Replica.matches(task, field, value, attr)
+        case "prefix" | "contains":
+            test = str.startswith if op == "prefix" else str.__contains__
+            if attr:
+                return any(attribute["name"] == field and test(attribute["value"], value)
+                           for attribute in task["attributes"])
+            return test(str(task[field]), value)
+        case _:
+            key = Replica.sort_key(task, field, attr)
+            if key is None:
+                return False
+            match op:
+                case "lt":
+                    return key < bound(predicate)
+                case "le":
+                    return key <= bound(predicate)
+                case "gt":
+                    return key > bound(predicate)
+                case _:
+                    return key >= bound(predicate)
+
+
+class Descending:
+    """Wraps a sort key so it sorts the other way"""
+    __slots__ = ("key",)
+
+    def __init__(self, key: tuple):
+        self.key = key
+
+    def __eq__(self, other) -> bool:
+        return self.key == other.key
+
+    def __lt__(self, other) -> bool:
+        return other.key < self.key
+
+
+def order(ids: set[int] | None, tasks: dict[int, dict], sort: list[dict], count: int | None,
+          replica: Replica = None, first: int = None) -> Iterator[int]:
+    """Put the matching tasks in order
+    :param ids: The IDs of the matching tasks, or None for all of them
+    :param tasks: Every task, by ID
+    :param sort: The keys to sort by, each a {"field", "attr", "order"}. Tasks without an attribute go last
+    (first when that key is descending), and ties are left in ID order
+    :param count: How many IDs will be read, or None for all of them. When the tasks have to be sorted,
+    only this many are picked out, with a heap, instead of sorting all of them
+    :param replica: The replica to take a kept sort order from, if it is up to date
+    :param first: With count None, how many IDs are read straight away, like the first chunk of a stream.
+    Only those are picked out with a heap at first, and the rest are only sorted if they are read
+    :return: The IDs in order. With a kept order, or first, they are only worked out as they are read
+    """
+    candidates = sorted(ids) if ids is not None else tasks
+    if not sort:
+        return iter(candidates)
+    task_key = replica.cached_key if replica is not None else Replica.sort_key
+
+    if len(sort) == 1:
+        field, attr = sort[0]["field"], sort[0].get("attr", False)
+        descending = sort[0].get("order") == "desc"
+        if replica is not None:
+            # Read straight out of the kept order, stopping once there are enough
+            entries = replica.order_for(field, attr)
+            in_order = (task_id for _, task_id in (reversed(entries) if descending else entries)
+                        if ids is None or task_id in ids)
+        else:
+            entries = [(Replica.sort_key(tasks[task_id], field, attr), task_id) for task_id in candidates]
+            entries = [entry for entry in entries if entry[0] is not None]
+            if count is None:
+                entries.sort(reverse=descending)
+            else:
+                entries = (heapq.nlargest if descending else heapq.nsmallest)(count, entries)
+            in_order = (task_id for _, task_id in entries)
+        if not attr:
+            return in_order
+        # Tasks without the attribute go after the rest, or before them when the order is reversed
+        missing = (task_id for task_id in candidates if task_key(tasks[task_id], field, attr) is None)
+        if descending:
+            return itertools.chain(reversed(list(missing)), in_order)
+        return itertools.chain(in_order, missing)
+
+    # Several keys are compared together, with the ID last so ties stay in ID order
+    def sort_key(task_id: int) -> tuple:
+        parts = []
+        for key in sort:
+            value = task_key(tasks[task_id], key["field"], key.get("attr", False))
+            value = (1,) if value is None else (0, value)
+            parts.append(Descending(value) if key.get("order") == "desc" else value)
+        return *parts, task_id
+
+    if count is not None:
+        return iter(heapq.nsmallest(count, candidates, key=sort_key))
+    if first is None:
+        return iter(sorted(candidates, key=sort_key))
+
+    def head_first() -> Iterator[int]:
+        top = heapq.nsmallest(first, candidates, key=sort_key)
+        yield from top
+        if len(top) == first:
+            yield from sorted(candidates, key=sort_key)[first:]
+
+    return head_first()
+
+
+class Streams:
+    """Results that are being sent a chunk at a time. A stream is read from the replica as it is sent,
+    so it ends if the replica changes in between. Only the most recent streams are kept open.
+    """
+
+    def __init__(self, size: int = 16):
+        self.size = size
+        self.open: collections.OrderedDict[int, tuple[Iterator[int], int | None, int]] = collections.OrderedDict()
+        self.next_id = 0
+
+    def start(self, in_order: Iterator[int], revision: int | None, chunk: int) -> dict:
+        """Send the first chunk of a result, and keep the rest to be asked for
+        :param in_order: The IDs still to send
+        :param revision: The replica revision the IDs are read from, or None if they aren't read from it
+        :param chunk: How many IDs to send at a time
+        :return: The response, with the first chunk, and the ID of the stream if there is more
+        """
+        stream_id = self.next_id
+        self.next_id += 1
+        self.open[stream_id] = (in_order, revision, chunk)
+        while len(self.open) > self.size:
+            self.open.popitem(last=False)
+        return self.more(stream_id, revision)
+
+    def more(self, stream_id: int, revision: int | None) -> dict:
+        """Send the next chunk of a stream
+        :param stream_id: The stream
+        :param revision: The revision of the replica now
+        :return: The response, with the chunk, and the ID of the stream if there is still more.
+        410 if the stream has ended, or the replica has changed since it started
+        """
+        if stream_id not in self.open:
+            return {"code": 410, "message": "Gone", "data": None}
+        in_order, started, chunk = self.open.pop(stream_id)
+        if started is not None and started != revision:
+            return {"code": 410, "message": "Gone", "data": None}
+        id_list = list(itertools.islice(in_order, chunk + 1))
+        if len(id_list) > chunk:
+            # There is at least one more, so put the one that was looked ahead at back in front
+            self.open[stream_id] = (itertools.chain(id_list[chunk:], in_order), started, chunk)
+            return {"code": 200, "message": "Queried", "data": id_list[:chunk], "stream": stream_id}
+        return {"code": 200, "message": "Queried", "data": id_list, "stream": None}
+
+
+class ResultCache:
+    """The results of the last queries that were run, so going back to one of them doesn't work it out again.
+    Results are kept by the query and the replica revision they were worked out at, so they stop being used as soon
+    as the tasks change, and are dropped once a newer revision is seen.
+    The least recently used results are dropped when there are more than entries of them, or more than ids IDs in all.
+    """
+
+    def __init__(self, entries: int = 64, ids: int = 1000000):
+        self.entries = entries
+        self.ids = ids
+        # (query, revision) to the IDs from the front of the result, and whether that is all of them
+        self.results: collections.OrderedDict[tuple[str, int], tuple[list[int], bool]] = collections.OrderedDict()
+        self.size = 0  # IDs kept in all
+        self.revision = None
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, query: str, revision: int, end: int | None) -> list[int] | None:
+        """Get a kept result
+        :param query: The query, from normalize
+        :param revision: The revision of the replica now
+        :param end: How many IDs are needed from the front of the result, or None for all of them
+        :return: The IDs, or None if they aren't kept, or not enough of them are
+        """
+        self.expire(revision)
+        entry = self.results.get((query, revision))
+        if entry is not None and (entry[1] or (end is not None and end <= len(entry[0]))):
+            self.results.move_to_end((query, revision))
+            self.stats["hits"] += 1
+            return entry[0]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, query: str, revision: int, id_list: list[int], complete: bool):
+        """Keep a result
+        :param query: The query, from normalize
+        :param revision: The revision of the replica it was worked out at
+        :param id_list: The IDs from the front of the result. Never change this list once it is kept
+        :param complete: True if that is all of them
+        """
+        self.expire(revision)
+        old = self.results.pop((query, revision), None)
+        if old is not None:
+            self.size -= len(old[0])
+        if len(id_list) > self.ids:
+            return
+        self.results[(query, revision)] = (id_list, complete)
+        self.size += len(id_list)
+        while len(self.results) > self.entries or self.size > self.ids:
+            self.size -= len(self.results.popitem(last=False)[1][0])
+
+    def expire(self, revision: int):
+        """Drop every result from before a revision, since they can't be used again"""
+        if revision != self.revision:
+            self.results.clear()
+            self.size = 0
+            self.revision = revision
+
+
+def normalize(predicate: dict | None, sort: list[dict]) -> str:
+    """Turn a query into a string that is the same for every way of writing it, like leaving out attr or order
+    :param predicate: The filter, which has already been checked
+    :param sort: The keys to sort by
+    :return: The string
+    """
+    def clean(predicate: dict) -> dict:
+        if "and" in predicate:
+            return {"and": [clean(part) for part in predicate["and"]]}
+        if "or" in predicate:
+            return {"or": [clean(part) for part in predicate["or"]]}
+        return {"field": predicate["field"], "attr": bool(predicate.get("attr", False)),
+                "op": predicate["op"], "value": predicate["value"]}
+
+    sort = [{"field": key["field"], "attr": bool(key.get("attr", False)),
+             "order": "desc" if key.get("order") == "desc" else "asc"} for key in sort]
+    return json.dumps({"filter": clean(predicate) if predicate is not None else None, "sort": sort}, sort_keys=True)
+
+
+def kept(in_order: Iterator[int], cache: ResultCache, query: str, replica: Replica) -> Iterator[int]:
+    """Pass a stream's IDs through, keeping the whole result once the last of them has been read
+    :param in_order: The IDs, in order
+    :param cache: Where to keep the result
+    :param query: The query, from normalize
+    :param replica: The replica the result is worked out from. If it has changed by the end, the result isn't kept
+    """
+    revision = replica.revision
+    id_list = []
+    for task_id in in_order:
+        id_list.append(task_id)
+        yield task_id
+    if replica.revision == revision:
+        cache.put(query, revision, id_list, True)
+
+
+def columns_for(replica: Replica) -> columns.Columns:
+    """Get the replica's tasks as columns, building them again if the replica has changed since"""
+    if replica.columns is None or replica.columns.revision != replica.revision:
+        replica.columns = columns.Columns(replica.tasks.values(), replica.cached_key, replica.revision)
+    return replica.columns
+
+
+def run(replica: Replica, streams: Streams, message: dict, columnar_threshold: int = None,
+        cache: ResultCache = None) -> dict:
+    """Answer a query request
+    :param replica: The replica to answer it from
+    :param streams: Where to keep the rest of a result that is sent in chunks
+    :param message: The request, with an optional filter, sort, offset, and limit.
+    With stream set to a number, the IDs are sent that many at a time
+    :param columnar_threshold: The fewest tasks to answer from numpy columns instead, or None to never use them
+    :param cache: Where to keep results, to answer the same query from while the replica stays the same
+    :return: A response with the IDs of the matching tasks, in order
+    """
+    predicate = message.get("filter")
+    sort = message.get("sort") or []
+    offset = message.get("offset") or 0
+    limit = message.get("limit")
+    chunk = message.get("stream")
+    try:
+        check(predicate)
+        for key in sort:
+            if not key.get("attr", False) and key.get("field") not in Replica.fields:
+                raise ValueError(f"Unknown field {key.get('field')}")
+        for number in (offset, limit, chunk):
+            if number is not None and (not isinstance(number, int) or number < 0):
+                raise ValueError("offset, limit, and stream have to be positive numbers")
+        if chunk == 0:
+            raise ValueError("Streams have to send at least one ID at a time")
+    except (AttributeError, TypeError, ValueError):
+        return {"code": 400, "message": "Invalid Request", "data": None}
+
+    end = offset + limit if limit is not None else None
+    response = replica.prepare()
+    revision = None  # The revision of the replica, if the IDs are read from it as they are sent
+    normalized = normalize(predicate, sort)
+    cached = cache.get(normalized, replica.revision, end) if cache is not None and response is None else None
+    if cached is not None:
+        in_order = iter(cached)
+    elif response is None and columns.usable(len(replica.tasks), columnar_threshold):
+        # The whole result is worked out at once, so a stream of it doesn't depend on the replica staying the same
+        in_order = iter(columns_for(replica).query(predicate, sort, end).tolist())
+    elif response is None:
+        ids = select(replica, predicate) if predicate is not None else None
+        # A stream only needs its first chunk, and one more to tell if there are others, before it is answered
+        first = offset + chunk + 1 if chunk is not None else None
+        in_order = order(ids, replica.tasks, sort, end, replica, first)
+        revision = replica.revision
+    elif response["code"] != 200:
+        return response
+    elif columns.usable(len(response["data"]), columnar_threshold):
+        in_order = iter(columns.Columns(response["data"], Replica.sort_key).query(predicate, sort, end).tolist())
+    else:
+        tasks = {task["id"]: task for task in response["data"]}
+        ids = {task_id for task_id, task in tasks.items() if matches(task, predicate)} if predicate is not None else None
+        in_order = order(ids, tasks, sort, end, first=offset + chunk + 1 if chunk is not None else None)
+    if cached is None and cache is not None and response is None and chunk is None:
+        id_list = list(itertools.islice(in_order, end))
+        cache.put(normalized, replica.revision, id_list, end is None or len(id_list) < end)
+        in_order = iter(id_list)
+    elif cached is None and cache is not None and response is None and end is None:
+        # A stream only works out what has been asked for so far, so it is kept once it has all been read
+        in_order = kept(in_order, cache, normalized, replica)
+    in_order = itertools.islice(in_order, offset, end)
+    if chunk is not None:
+        return streams.start(in_order, revision, chunk)
+    return {"code": 200, "message": "Queried", "data": list(in_order)}
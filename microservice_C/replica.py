@@ -0,0 +1,322 @@
+import bisect
+import datetime
+import json
+import re
+import threading
+import time
+import zmq
+from pool import Coalescer
+from search import SearchIndex
+
+
+NUMBER = re.compile(r"-?\d+(\.\d+)?")
+ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+US_DATE = re.compile(r"\d{1,2}/\d{1,2}/\d{4}")
+
+
+def typed_key(value: str) -> tuple:
+    """Turn a value into a key that sorts it by what it holds. Numbers sort as numbers, then dates
+    (2024-01-31 or 01/31/2024) by the day, then everything else as text. Any two keys can be compared
+    :param value: The value, as it is stored
+    :return: The key
+    """
+    if NUMBER.fullmatch(value):
+        return 0, float(value) if "." in value else int(value)
+    try:
+        if ISO_DATE.fullmatch(value):
+            return 1, datetime.date.fromisoformat(value).toordinal()
+        if US_DATE.fullmatch(value):
+            return 1, datetime.datetime.strptime(value, "%m/%d/%Y").toordinal()
+    except ValueError:
+        pass  # Looks like a date, but isn't a real day
+    return 2, value
+
+
+def bound(predicate: dict) -> tuple:
+    """The sort key a range filter compares against, worked out the same way as Replica.sort_key"""
+    field, value = predicate["field"], predicate["value"]
+    if not predicate.get("attr", False) and field in ("id", "parent"):
+        return 0, int(value)
+    return typed_key(value)
+
+
+class Replica:
+    """A copy of the server's tasks, kept up to date from its change feed, so sorting and filtering
+    doesn't have to download every task each time.
+    Before answering, the replica applies any changes pushed by the server. If it has no push connection,
+    or hasn't checked for check_interval seconds, it asks the server what changed since its revision.
+    If there are more than max_tasks tasks, nothing is kept, and every request fetches them again.
+    The copy has indexes from each field value, and each attribute name and value, to the IDs of the tasks
+    that have them, so a filter is a lookup instead of going through every task.
+    It also keeps each order that has been asked for as a sorted list, which new and changed tasks are inserted into,
+    so a sort only has to read the IDs back out.
+    Words in the names, descriptions, and attribute values are indexed too, for searching.
+    The replica is shared between threads, so everything that uses it has to hold its lock.
+    The lock is let go while waiting for the server, so other requests can still be answered while it is slow.
+    """
+
+    # The fields that are indexed for filtering, other than attributes
+    fields = ["id", "name", "date", "parent", "description", "status"]
+
+    def __init__(self, request, subscriber: zmq.Socket = None, max_tasks: int = 100000, check_interval: float = 0):
+        """
+        :param request: Function that sends a request to the server and returns its response
+        :param subscriber: SUB socket subscribed to the server's changes, if it publishes them
+        :param max_tasks: The most tasks to keep a copy of
+        :param check_interval: Seconds between asking the server for changes, when they are also being pushed
+        """
+        self.request = request
+        self.subscriber = subscriber
+        self.max_tasks = max_tasks
+        self.check_interval = check_interval
+        self.tasks: dict[int, dict] = {}
+        # Field to the value as a string, to the IDs of the tasks with it
+        self.field_index: dict[str, dict[str, set[int]]] = {field: {} for field in self.fields}
+        # (attribute name, value) to the IDs of the tasks with it
+        self.attribute_index: dict[tuple[str, str], set[int]] = {}
+        # (attr, field or attribute name) to (sort key, ID) for each task that has it, in order
+        self.sort_index: dict[tuple[bool, str], list[tuple]] = {}
+        # Task ID to the sort keys worked out for the copy of it that is kept, so they are only parsed once
+        self.key_cache: dict[int, dict[tuple[bool, str], tuple | None]] = {}
+        self.columns = None  # The copy as numpy columns, for large queries, built by query.columns_for
+        self.search_index = SearchIndex()
+        self.revision = None  # None when there is no copy
+        self.last_check = 0
+        self.stats = {"hits": 0, "misses": 0, "updates": 0}
+        self.lock = threading.Lock()
+        self.fetches = Coalescer()  # Requests that need the same thing from the server at the same time share it
+
+    def prepare(self) -> dict | None:
+        """Bring the copy up to date before answering a request, fetching everything if there isn't one
+        :return: None if the copy and its indexes can be used. Otherwise the server's response,
+        with every task or an error
+        """
+        if self.fresh():
+            self.stats["hits"] += 1
+            return None
+        self.stats["misses"] += 1
+        response = self.load()
+        if response["code"] == 200 and self.revision is not None:
+            return None
+        return response
+
+    def filter(self, field: str, value: str, attr: bool) -> dict:
+        """Find the tasks where a field, or an attribute, has a value
+        :param field: The field, or name of the attribute
+        :param value: The value to match, compared as a string
+        :param attr: True if field is the name of an attribute
+        :return: A response with the IDs of the matching tasks, in ID order
+        """
+        response = self.prepare()
+        if response is not None:
+            if response["code"] != 200:
+                return response
+            # Too many tasks to keep, so there are no indexes either
+            id_list = [task["id"] for task in response["data"] if self.matches(task, field, value, attr)]
+            return {"code": 200, "message": "Filtered", "data": id_list}
+        if attr:
+            ids = self.attribute_index.get((field, value), set())
+        else:
+            ids = self.field_index[field].get(value, set())
+        return {"code": 200, "message": "Filtered", "data": sorted(ids)}
+
+    def search(self, text: str, limit: int = None) -> dict:
+        """Find the tasks whose names, descriptions, or attribute values have the words in some text
+        :param text: What to search for. The last word can be the start of a word
+        :param limit: The most IDs to return, or None for all of them
+        :return: A response with the IDs of the matching tasks, best match first
+        """
+        response = self.prepare()
+        if response is not None:
+            if response["code"] != 200:
+                return response
+            # Too many tasks to keep, so the index has to be built just for this
+            search_index = SearchIndex()
+            for task in response["data"]:
+                search_index.add(task)
+            return {"code": 200, "message": "Searched", "data": search_index.search(text, limit)}
+        return {"code": 200, "message": "Searched", "data": self.search_index.search(text, limit)}
+
+    def order_for(self, field: str, attr: bool) -> list[tuple]:
+        """Get the sorted (sort key, ID) pairs for a field or attribute, building them the first time"""
+        if (attr, field) not in self.sort_index:
+            self.sort_index[(attr, field)] = self.build_order(self.tasks.values(), field, attr, self.cached_key)
+        return self.sort_index[(attr, field)]
+
+    @classmethod
+    def build_order(cls, tasks, field: str, attr: bool, sort_key=None) -> list[tuple]:
+        """Sort tasks from scratch, as the (sort key, ID) pairs kept in sort_index
+        :param sort_key: Function that gets the key of a task, if not sort_key itself
+        """
+        sort_key = sort_key or cls.sort_key
+        order = [(sort_key(task, field, attr), task["id"]) for task in tasks]
+        return sorted(entry for entry in order if entry[0] is not None)
+
+    @staticmethod
+    def sort_key(task: dict, field: str, attr: bool) -> tuple | None:
+        """What to sort a task by, using typed_key for anything stored as text
+        :return: The key, or None if the task doesn't have the attribute
+        """
+        if not attr:
+            if task[field] is None:
+                # A task without a parent sorts before the ones with one
+                return (-1,)
+            return (0, task[field]) if isinstance(task[field], int) else typed_key(task[field])
+        for attribute in task["attributes"]:
+            if attribute["name"] == field:
+                return typed_key(attribute["value"])
+        return None
+
+    def cached_key(self, task: dict, field: str, attr: bool) -> tuple | None:
+        """Get the sort key of a task in the copy, only working it out the first time"""
+        keys = self.key_cache.setdefault(task["id"], {})
+        if (attr, field) not in keys:
+            keys[(attr, field)] = self.sort_key(task, field, attr)
+        return keys[(attr, field)]
+
+    @staticmethod
+    def matches(task: dict, field: str, value: str, attr: bool) -> bool:
+        """Check if a field, or an attribute, of a task has a value"""
+        if attr:
+            return any(attribute["name"] == field and attribute["value"] == value for attribute in task["attributes"])
+        return str(task[field]) == value
+
+    def fresh(self) -> bool:
+        """Bring the copy up to date with the server
+        :return: True if there is a copy
+        """
+        if self.revision is not None:
+            self.receive_changes()
+        if self.revision is not None and (self.subscriber is None
+                                          or time.monotonic() - self.last_check >= self.check_interval):
+            self.check_changes()
+        return self.revision is not None
+
+    def load(self) -> dict:
+        """Fetch every task from the server, and keep a copy if there aren't too many.
+        The lock is let go while waiting for the server, so another request can have updated the copy by the time
+        this returns
+        :return: The server's response
+        """
+        self.lock.release()
+        try:
+            revision, response = self.fetches.run("tasks", self.fetch)
+        finally:
+            self.lock.acquire()
+        if (response["code"] == 200 and revision is not None and len(response["data"]) <= self.max_tasks
+                and (self.revision is None or self.revision < revision)):
+            self.drop()
+            for task in response["data"]:
+                self.tasks[task["id"]] = task
+                self.index(task)
+            self.revision = revision
+            self.last_check = time.monotonic()
+        return response
+
+    def fetch(self) -> tuple[int | None, dict]:
+        """Get the server's revision, and then every task
+        :return: The revision, or None if the server doesn't keep a change feed, and the server's response
+        """
+        # The revision has to come first, so a change made during the fetch is caught by the next check
+        response = self.request({"type": "get", "path": "changes", "data": None})
+        revision = response["data"]["revision"] if response["code"] == 200 else None
+        return revision, self.request({"type": "get", "path": "tasks/all", "data": None})
+
+    def receive_changes(self):
+        """Apply the changes the server has pushed since the last request"""
+        if self.subscriber is None:
+            return
+        while self.revision is not None:
+            try:
+                frames = self.subscriber.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            changes = json.loads(frames[-1])
+            if changes["revision"] <= self.revision:
+                continue
+            if changes["revision"] != self.revision + 1:
+                # Some were missed, so ask the server for everything since the copy instead
+                self.check_changes()
+                continue
+            self.apply(changes)
+
+    def check_changes(self):
+        """Ask the server for the changes since the copy's revision. Drops the copy if they are gone.
+        Like load, the lock is let go while waiting for the server, and the same check from other requests is shared
+        """
+        since = self.revision
+        path = f"changes?since={since}"
+        self.lock.release()
+        try:
+            response = self.fetches.run(path, lambda: self.request({"type": "get", "path": path, "data": None}))
+        finally:
+            self.lock.acquire()
+        if self.revision != since:
+            # Another request brought the copy up to date, or dropped it, while this one was waiting
+            return
+        self.last_check = time.monotonic()
+        if response["code"] == 200:
+            self.apply(response["data"])
+        else:
+            self.drop()
+
+    def apply(self, changes: dict):
+        """Update the copy with the records that changed on the server"""
+        for task in changes["created"]["tasks"] + changes["updated"]["tasks"]:
+            if task["id"] in self.tasks:
+                self.unindex(self.tasks[task["id"]])
+                self.key_cache.pop(task["id"], None)
+            self.tasks[task["id"]] = task
+            self.index(task)
+        for task_id in changes["deleted"]["tasks"]:
+            if task_id in self.tasks:
+                self.unindex(self.tasks.pop(task_id))
+                self.key_cache.pop(task_id, None)
+        if changes["revision"] != self.revision:
+            self.stats["updates"] += 1
+        self.revision = changes["revision"]
+        if len(self.tasks) > self.max_tasks:
+            self.drop()
+
+    def drop(self):
+        """Throw the copy away, so the next request fetches everything again"""
+        self.tasks = {}
+        self.field_index = {field: {} for field in self.fields}
+        self.attribute_index = {}
+        self.sort_index = {}
+        self.key_cache = {}
+        self.columns = None
+        self.search_index = SearchIndex()
+        self.revision = None
+
+    def index(self, task: dict):
+        """Add a task to the indexes"""
+        for field in self.fields:
+            self.field_index[field].setdefault(str(task[field]), set()).add(task["id"])
+        for attribute in task["attributes"]:
+            self.attribute_index.setdefault((attribute["name"], attribute["value"]), set()).add(task["id"])
+        self.search_index.add(task)
+        for (attr, field), order in self.sort_index.items():
+            key = self.cached_key(task, field, attr)
+            if key is not None:
+                bisect.insort(order, (key, task["id"]))
+
+    def unindex(self, task: dict):
+        """Take a task out of the indexes, dropping any values that no task has anymore"""
+        for field in self.fields:
+            self.remove_id(self.field_index[field], str(task[field]), task["id"])
+        for attribute in task["attributes"]:
+            self.remove_id(self.attribute_index, (attribute["name"], attribute["value"]), task["id"])
+        self.search_index.remove(task["id"])
+        for (attr, field), order in self.sort_index.items():
+            key = self.cached_key(task, field, attr)
+            if key is not None:
+                del order[bisect.bisect_left(order, (key, task["id"]))]
+
+    @staticmethod
+    def remove_id(index: dict, key, task_id: int):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(task_id)
+            if not ids:
+                del index[key]
@@ -0,0 +1,92 @@
+import bisect
+import heapq
+import math
+import re
+
+WORD = re.compile(r"\w+")
+
+# How much a word counts for, depending on where in the task it is
+WEIGHTS = {"name": 3, "description": 1, "attribute": 1}
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lowercase words"""
+    return WORD.findall(text.lower())
+
+
+class SearchIndex:
+    """An inverted index from each word in the tasks' names, descriptions, and attribute values,
+    to the tasks it is in. Tasks are added and removed one at a time as they change, so searching never has to
+    go through every task.
+    """
+
+    def __init__(self):
+        # Word to the ID of each task it is in, and how much it counts for there
+        self.postings: dict[str, dict[int, int]] = {}
+        # Every word, in order, so the words starting with something can be found with a binary search
+        self.words: list[str] = []
+        # Task ID to the words it was indexed under, to take it back out
+        self.task_words: dict[int, dict[str, int]] = {}
+
+    def add(self, task: dict):
+        """Index a task. It can't already be in the index"""
+        counts = {}
+        texts = [("name", task["name"]), ("description", task["description"])]
+        texts += [("attribute", attribute["value"]) for attribute in task["attributes"]]
+        for place, text in texts:
+            for word in tokenize(str(text)):
+                counts[word] = counts.get(word, 0) + WEIGHTS[place]
+        for word, weight in counts.items():
+            if word not in self.postings:
+                self.postings[word] = {}
+                bisect.insort(self.words, word)
+            self.postings[word][task["id"]] = weight
+        self.task_words[task["id"]] = counts
+
+    def remove(self, task_id: int):
+        """Take a task out of the index, dropping any words no task has anymore"""
+        for word in self.task_words.pop(task_id, {}):
+            postings = self.postings[word]
+            del postings[task_id]
+            if not postings:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+    def starting_with(self, prefix: str) -> list[str]:
+        """Get the words that start with a prefix"""
+        start = bisect.bisect_left(self.words, prefix)
+        end = start
+        while end < len(self.words) and self.words[end].startswith(prefix):
+            end += 1
+        return self.words[start:end]
+
+    def search(self, text: str, limit: int = None) -> list[int]:
+        """Find the tasks that have every word in some text. The last word can be the start of a word,
+        so results can be shown while it is still being typed
+        :param text: What to search for
+        :param limit: The most IDs to return, or None for all of them
+        :return: The IDs of the tasks, best match first. A task scores higher for each time a word is in it,
+        most of all in its name, and for words that are in fewer tasks. Ties are in ID order
+        """
+        terms = tokenize(text)
+        if not terms:
+            return []
+        scores = None
+        for i, term in enumerate(terms):
+            words = self.starting_with(term) if i == len(terms) - 1 else ([term] if term in self.postings else [])
+            term_scores = {}
+            for word in words:
+                rarity = math.log(1 + len(self.task_words) / len(self.postings[word]))
+                for task_id, weight in self.postings[word].items():
+                    term_scores[task_id] = term_scores.get(task_id, 0) + weight * rarity
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {task_id: score + term_scores[task_id] for task_id, score in scores.items()
+                          if task_id in term_scores}
+            if not scores:
+                return []
+        ranked = ((-score, task_id) for task_id, score in scores.items())
+        if limit is None:
+            return [task_id for _, task_id in sorted(ranked)]
+        return [task_id for _, task_id in heapq.nsmallest(limit, ranked)]
@@ -1,86 +1,130 @@
 import zmq
+import argparse
 import json
+import threading
+import wire
+import query
+from pool import Coalescer, ConnectionPool
+from replica import Replica
 
-context = zmq.Context()
-ui_socket = context.socket(zmq.REP)
-print("Starting Sorting Microservice")
-ui_socket.bind("tcp://*:6666")
+parser = argparse.ArgumentParser()
+parser.add_argument('--max-tasks', type=int, default=100000,
+                    help='The most tasks to keep a copy of. With more than this, every request fetches them again')
+parser.add_argument('--server-pub-port', type=int, default=None,
+                    help="Port the server publishes its changes on, if it was started with --pub-port")
+parser.add_argument('--check-interval', type=float, default=5.0,
+                    help='Seconds between asking the server for changes, when they are also being published')
+parser.add_argument('--columnar-threshold', type=int, default=20000,
+                    help='The fewest tasks to filter and sort with numpy columns, if numpy is installed')
+parser.add_argument('--workers', type=int, default=4,
+                    help='Number of threads answering requests at the same time')
+parser.add_argument('--connections', type=int, default=4,
+                    help='Number of connections to the server, for requests waiting on it at the same time')
+parser.add_argument('--cache-entries', type=int, default=64,
+                    help='The most query results to keep, to answer the same query again while the tasks are the same')
+parser.add_argument('--cache-ids', type=int, default=1000000,
+                    help='The most task IDs to keep in all the query results kept')
+args = parser.parse_args()
 
-server_socket = context.socket(zmq.REQ)
+context = zmq.Context()
+# Talk to the server in msgpack when it's installed, since the whole task list comes back on every request
+server_encoding = "msgpack" if "msgpack" in wire.ENCODINGS else None
 print("Connecting to Server")
-server_socket.connect("tcp://localhost:5555")
+upstream = ConnectionPool(context, "tcp://localhost:5555", args.connections, server_encoding)
+
+subscriber = None
+if args.server_pub_port is not None:
+    subscriber = context.socket(zmq.SUB)
+    subscriber.connect(f"tcp://localhost:{args.server_pub_port}")
+    subscriber.setsockopt(zmq.SUBSCRIBE, b"changes")
+
+replica = Replica(upstream.request, subscriber, args.max_tasks,
+                  args.check_interval if subscriber is not None else 0)
+streams = query.Streams()
+cache = query.ResultCache(args.cache_entries, args.cache_ids)
+in_flight = Coalescer()
+
 
-while True:
-    #  Wait for next request from client
-    message = str(ui_socket.recv_string())
-    print(f"Received request: {message}")
-    message = json.loads(message)
+def handle(message: dict) -> dict:
+    """Answer a request from the UI
+    :param message: The request
+    :return: The response
+    """
     type = message["type"]
+    if type == "stats":
+        return {"code": 200, "message": "Stats", "data": {**replica.stats, "revision": replica.revision,
+                                                           "tasks": len(replica.tasks),
+                                                           "coalesced": in_flight.shared, "cache": cache.stats}}
+    if type == "query":
+        return query.run(replica, streams, message, args.columnar_threshold, cache)
+    if type == "more":
+        return streams.more(message["stream"], replica.revision)
+    if type == "search":
+        text, limit = message.get("text"), message.get("limit")
+        if not isinstance(text, str) or (limit is not None and (not isinstance(limit, int) or limit < 0)):
+            return {"code": 400, "message": "Invalid Request", "data": None}
+        return replica.search(text, limit)
     limiter = message["limiter"]
     attr = message["attr"]
-    if limiter == "":
-        ui_socket.send_string(json.dumps({"code": 400, "message": "Invalid Request", "data": None}))
-        continue
+    if limiter == "" or (not attr and limiter not in Replica.fields):
+        return {"code": 400, "message": "Invalid Request", "data": None}
     if type == "sort":
-        order = message["order"]
-        server_socket.send_string(json.dumps({"type": "get", "path": "tasks/all", "data": None}))
-        response = server_socket.recv_string()
-        response = json.loads(response)
+        sort = [{"field": limiter, "attr": attr, "order": message["order"]}]
+        response = query.run(replica, streams, {**message, "filter": None, "sort": sort},
+                             args.columnar_threshold, cache)
         if response["code"] == 200:
-            tasks = response["data"]
-            extra_tasks = []
-            if attr:
-                tasks_with_attr = []
-                for task in tasks:
-                    for attribute in task["attributes"]:
-                        if attribute["name"] == limiter:
-                            value = int(attribute["value"]) if attribute["value"].isdigit() else attribute["value"]
-                            tasks_with_attr.append({value: task})
-                            break
-                    else:
-                        extra_tasks.append(task["id"])
+            response["message"] = "Sorted"
+        return response
+    if type == "filter":
+        return replica.filter(limiter, message["filter"], attr)
+    return {"code": 400, "message": "Invalid Request", "data": None}
 
 
-                tasks = sorted(tasks_with_attr, key=lambda x: list(x.keys())[0])
-                id_list = []
-                for task in tasks:
-                    id_list.append(list(task.values())[0]["id"])
+def locked_handle(message: dict) -> dict:
+    """Answer a request while holding the replica's lock"""
+    with replica.lock:
+        return handle(message)
 
-            else:
-                tasks = sorted(tasks, key=lambda x: x[limiter])
-                id_list = []
-                for task in tasks:
-                    id_list.append(task["id"])
-            id_list += extra_tasks
-            if order == "desc":
-                id_list = id_list[::-1]
 
-            ui_socket.send_string(json.dumps({"code": 200, "message": "Sorted", "data": id_list}))
-        else:
-            ui_socket.send_string(json.dumps(response))
-    elif type == "filter":
-        filter = message["filter"]
-        server_socket.send_string(json.dumps({"type": "get", "path": "tasks/all", "data": None}))
-        response = server_socket.recv_string()
-        response = json.loads(response)
-        if response["code"] == 200:
-            tasks = response["data"]
-            filtered = []
-            if attr:
-                for task in tasks:
-                    for attribute in task["attributes"]:
-                        if attribute["name"] == limiter and attribute["value"] == filter:
-                            filtered.append(task)
-                            break
+def worker(worker_id: int):
+    """Answer requests passed on from the frontend
+    :param worker_id: Number of the worker, used in logs
+    """
+    socket = context.socket(zmq.REP)
+    socket.connect("inproc://workers")
+    while True:
+        #  Wait for next request from client
+        try:
+            message, encoding = wire.decode(socket.recv_multipart())
+        except ValueError as error:
+            socket.send_multipart(wire.encode({"code": 415, "message": str(error), "data": None}, None))
+            continue
+        print(f"Worker {worker_id} received request: {message}")
+        try:
+            if message.get("type") in ("query", "sort", "filter", "search") and message.get("stream") is None:
+                # The same request arriving while one is being answered waits for that answer.
+                # Streams aren't shared, since each client reads its own chunks
+                key = json.dumps(message, sort_keys=True)
+                response = in_flight.run(key, lambda: locked_handle(message))
             else:
-                for task in tasks:
-                    if str(task[limiter]) == filter:
-                        filtered.append(task)
-            id_list = []
-            for task in filtered:
-                id_list.append(task["id"])
-            ui_socket.send_string(json.dumps({"code": 200, "message": "Filtered", "data": id_list}))
-        else:
-            ui_socket.send_string(json.dumps(response))
-    else:
-        ui_socket.send_string(json.dumps({"code": 400, "message": "Invalid Request", "data": None}))
+                response = locked_handle(message)
+        except (AttributeError, KeyError, TypeError):
+            # Missing or wrongly shaped fields, like a sort without a limiter
+            response = {"code": 400, "message": "Invalid Request", "data": None}
+        except Exception as error:
+            # The client is still waiting for a reply, and the worker has to carry on to answer the next request
+            print(f"Worker {worker_id} failed to answer {message}: {error!r}")
+            response = {"code": 500, "message": "Internal Server Error", "data": None}
+        #  Send reply back to client, in the same encoding as its request
+        socket.send_multipart(wire.encode(response, encoding))
+
+
+# Clients connect to the frontend like before, and their requests are shared out between the workers
+frontend = context.socket(zmq.ROUTER)
+backend = context.socket(zmq.DEALER)
+print("Starting Sorting Microservice")
+frontend.bind("tcp://*:6666")
+backend.bind("inproc://workers")
+for i in range(args.workers):
+    threading.Thread(target=worker, args=(i,), name=f"worker-{i}", daemon=True).start()
+zmq.proxy(frontend, backend)
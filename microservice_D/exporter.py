@@ -1,8 +1,488 @@
-import json
+import argparse
 import csv
+import hashlib
+import json
+import os
+import tempfile
 import zmq
+import formats
+from jobs import Jobs, Job
+from source import TaskSource, Moved
+
+FIELDS = ["ID", "Name", "Date", "Description"]
+OPERATORS = ["eq", "ne", "lt", "le", "gt", "ge", "prefix", "contains"]
+MODES = ["full", "delta", "patch"]
+ROW_GROUP_SIZE = 10000  # Rows written at a time, which is one row group in columnar formats
+PROGRESS_EVERY = 1000  # Tasks between progress updates, which is also how often a cancelled job notices
+RETRIES = 3  # Times an export starts again when the data changes while it is read, before getting it all at once
+SERVER = "tcp://localhost:5555"
+# Files are made with the permissions the user's umask gives them, which can only be read by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def read_columns(attributes: list[dict], tasks, typed: bool = True, job: Job = None) -> tuple[list[str], list[str], int]:
+    """Go through the tasks once, for the columns and the type of each.
+    Every value is looked at, so a column is only a number or a date if all of its values are
+    :param attributes: The attribute catalogue
+    :param tasks: Iterable of the tasks. If typed is False, they only need their IDs
+    :param typed: False to leave every column as text, which is quicker when the types aren't needed
+    :param job: The job doing the export, to stop if it is cancelled
+    :return: The names of the columns, with one for each attribute in the catalogue, their types,
+    and the number of tasks
+    """
+    fields = list(FIELDS)
+    for attribute in attributes:
+        if attribute["name"] not in fields:
+            fields.append(attribute["name"])
+    date_type = None
+    attribute_types = {}
+    count = 0
+    for task in tasks:
+        count += 1
+        if job is not None and count % PROGRESS_EVERY == 0:
+            job.progress(0)
+        if typed:
+            date_type = formats.widen(date_type, task["date"])
+            for attribute in task["attributes"]:
+                attribute_types[attribute["name"]] = formats.widen(attribute_types.get(attribute["name"]),
+                                                                   attribute["value"])
+    # Columns with no values at all are left as text
+    types = ["int" if typed else "string", "string", date_type or "string", "string"]
+    types += [attribute_types.get(name) or "string" for name in fields[len(FIELDS):]]
+    return fields, types, count
+
+
+def task_rows(tasks, fields: list[str], job: Job = None):
+    """Go through the tasks, a task at a time
+    :param tasks: Iterable of the tasks
+    :param fields: The columns, from read_columns
+    :param job: The job doing the export, to report progress to
+    :return: Generator of the row of each task, with its values as they are stored
+    """
+    # Attribute name to its column, so each task only has to go through its own attributes
+    attribute_columns = {name: i for i, name in enumerate(fields) if i >= len(FIELDS)}
+    for done, task in enumerate(tasks):
+        if job is not None and done % PROGRESS_EVERY == 0:
+            job.progress(done)
+        row = [task["id"], task["name"], task["date"], task["description"]] + [""] * len(attribute_columns)
+        filled = set()
+        for attribute in task["attributes"]:
+            column = attribute_columns.get(attribute["name"])
+            # The first value is used if a task has an attribute more than once
+            if column is not None and column not in filled:
+                row[column] = attribute["value"]
+                filled.add(column)
+        yield row
+
+
+def row_hash(row: list) -> str:
+    """A short hash of a row's values, to tell if it has changed since the last export"""
+    return hashlib.blake2b(json.dumps(row).encode(), digest_size=8).hexdigest()
+
+
+def export_path(request: dict) -> str:
+    """Where an export request writes to"""
+    return request.get("path") or f"../data.{request.get('format', 'csv')}"
+
+
+def delta_path(request: dict) -> str:
+    """Where a delta export request writes its changes to"""
+    stem = os.path.splitext(export_path(request))[0]
+    return request.get("delta_path") or f"{stem}.delta.{request.get('format', 'csv')}"
+
+
+def output_paths(request: dict) -> set[str]:
+    """The files an export request writes, other than the manifest that goes with the first,
+    so two exports never write the same one at once
+    """
+    paths = {export_path(request)}
+    if request.get("mode") == "delta":
+        paths.add(delta_path(request))
+    return {os.path.abspath(path) for path in paths}
+
+
+def temp_path(path: str) -> str:
+    """Make a new empty file next to a path, to write to before it replaces the path.
+    Each one has its own name, so nothing else can be writing to it
+    """
+    handle, temp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    os.close(handle)
+    # mkstemp makes it readable only by its owner, but the export should be like any other new file
+    os.chmod(temp, 0o666 & ~UMASK)
+    return temp
+
+
+def manifest_path(path: str) -> str:
+    """Where the manifest of the export at a path is kept"""
+    return path + ".manifest.json"
+
+
+def read_manifest(path: str) -> dict | None:
+    """Get the manifest of the last export to a path
+    :return: The manifest, or None if there isn't one
+    """
+    try:
+        with open(manifest_path(path)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(path: str, manifest: dict):
+    """Save the manifest of an export. It is written to a temporary file first, so a crash can't leave half of it"""
+    temp = temp_path(manifest_path(path))
+    with open(temp, "w") as file:
+        json.dump(manifest, file)
+    os.replace(temp, manifest_path(path))
+
+
+def write_rows(writer, rows) -> int:
+    """Write rows a group at a time
+    :param writer: The writer, from formats
+    :param rows: Iterable of the rows
+    :return: The number of rows written
+    """
+    count = 0
+    group = []
+    for row in rows:
+        group.append(row)
+        if len(group) == ROW_GROUP_SIZE:
+            writer.write(group)
+            count += len(group)
+            group = []
+    if group:
+        writer.write(group)
+        count += len(group)
+    return count
+
+
+def write_file(format: str, path: str, columns: list[str], types: list[str], rows) -> int:
+    """Write rows to a new file
+    :param format: The format, from formats.FORMATS
+    :param path: Where to write it
+    :param columns: The names of the columns
+    :param types: Their types
+    :param rows: Iterable of the rows, which can be a generator that is only gone through as the file is written
+    :return: The number of rows written
+    :raises Exception: Whatever went wrong while writing, including the job being cancelled.
+    Whatever was at the path before is left as it was
+    """
+    # Written to a temporary file, which only replaces the old one once it is all there
+    temp = temp_path(path)
+    try:
+        writer = formats.FORMATS[format](temp, columns, types)
+    except Exception:
+        os.remove(temp)
+        raise
+    try:
+        count = write_rows(writer, rows)
+    except Exception:
+        # Don't leave half of a file behind
+        writer.close()
+        os.remove(temp)
+        raise
+    writer.close()
+    os.replace(temp, path)
+    return count
+
+
+def old_rows(format: str, path: str, columns: list[str]):
+    """Go through the rows of a CSV or JSON Lines export
+    :return: Generator of each row, with its values as they were written
+    """
+    with open(path, newline="" if format == "csv" else None) as file:
+        if format == "csv":
+            reader = csv.reader(file)
+            next(reader)  # The header
+            yield from reader
+        else:
+            for line in file:
+                values = json.loads(line)
+                yield [values[column] for column in columns]
+
+
+def row_filter(predicate: list[dict] | dict | None, fields: list[str], types: list[str]):
+    """Make a function that checks a row against a filter
+    :param predicate: A test, like {"column": "Estimate", "op": "ge", "value": "3"}, or a list of them that all have to
+    pass. Values are compared by the type of their column, so 10 is more than 9 in a number column
+    :param fields: The columns of the rows
+    :param types: Their types
+    :return: The function, which takes a row and returns True if it passes
+    :raises ValueError: If the filter isn't one that can be run
+    """
+    if predicate is None:
+        return lambda row: True
+    tests = []
+    for test in predicate if isinstance(predicate, list) else [predicate]:
+        if test.get("column") not in fields:
+            raise ValueError(f"Unknown column {test.get('column')}")
+        if test.get("op") not in OPERATORS:
+            raise ValueError(f"Unknown operator {test.get('op')}")
+        if not isinstance(test.get("value"), str):
+            raise ValueError("Values are given as strings")
+        column = fields.index(test["column"])
+        if test["op"] in ("prefix", "contains"):
+            tests.append((column, "string", test["op"], test["value"]))
+        else:
+            tests.append((column, types[column], test["op"], formats.convert(test["value"], types[column])))
+
+    def passes(row: list) -> bool:
+        for column, column_type, op, value in tests:
+            cell = formats.convert(row[column], column_type)
+            match op:
+                case "eq":
+                    result = cell == value
+                case "ne":
+                    result = cell != value
+                case "prefix":
+                    result = cell.startswith(value)
+                case "contains":
+                    result = value in cell
+                case _:
+                    # Empty values can't be compared, so they never pass
+                    if cell is None or value is None:
+                        return False
+                    result = {"lt": cell < value, "le": cell <= value, "gt": cell > value, "ge": cell >= value}[op]
+            if not result:
+                return False
+        return True
+
+    return passes
+
+
+def deleted_row(key: str, columns: list[str]) -> list:
+    """The row written for a task that was deleted, which only has its ID"""
+    row = [None] * len(columns)
+    row[columns.index("ID")] = int(key)
+    return ["delete"] + row
+
+
+def write_changes(format: str, path: str, mode: str, request: dict, columns: list[str], types: list[str],
+                  changes: list[list]) -> tuple[str, int]:
+    """Write the rows that changed since the last export, to a delta file, or patched into the last export
+    :param changes: The changed rows, each with insert, update, or delete in front
+    :return: The path written to, and the number of changes
+    """
+    if mode == "delta":
+        output = delta_path(request)
+        return output, write_file(format, output, ["Change"] + columns, ["string"] + types, changes)
+    id_column = columns.index("ID")
+    changed = {str(change[1 + id_column]): change for change in changes}
+
+    def patched():
+        """The last export's rows, with the updated ones swapped in and the deleted ones left out,
+        then the inserted ones"""
+        for row in old_rows(format, path, columns):
+            change = changed.get(str(row[id_column]))
+            if change is None:
+                yield row
+            elif change[0] == "update":
+                yield change[1:]
+        yield from (change[1:] for change in changes if change[0] == "insert")
+
+    write_file(format, path, columns, types, patched())
+    return path, len(changes)
+
+
+def export_changes(source: TaskSource, request: dict, manifest: dict, job: Job = None) -> dict | None:
+    """Do a delta or patch export from the server's change feed, which has just the tasks that changed since
+    the last export, instead of going through every task to compare it to the manifest
+    :param source: The server
+    :param request: The export request
+    :param manifest: The manifest of the last export to the path
+    :param job: The job doing the export, to report progress to
+    :return: The response, or None if the changes can't be worked out this way, like when the feed doesn't go
+    back far enough, the catalogue has changed, or a changed value doesn't fit the type its column was written as
+    """
+    changes = source.changes(manifest["revision"])
+    # Changes to the catalogue can add or rename columns, which means going through every task again
+    if changes is None or "fields" not in manifest or any(changes[action]["attributes"]
+                                                           for action in ("created", "updated", "deleted")):
+        return None
+    fields, types = manifest["fields"], manifest["field_types"]
+    format = request.get("format", "csv")
+    path = export_path(request)
+    columns = request.get("columns") or fields
+    if "ID" not in columns:
+        return None
+    try:
+        selected = [fields.index(column) for column in columns]
+        passes = row_filter(request.get("filter"), fields, types)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    column_types = [types[i] for i in selected]
+    settings = {"format": format, "columns": columns, "types": column_types, "filter": request.get("filter")}
+    if settings != manifest["settings"] or (request["mode"] == "patch" and manifest.get("mode") == "delta"):
+        return None
+    tasks = changes["created"]["tasks"] + changes["updated"]["tasks"]
+    if job is not None:
+        job.progress(0, len(tasks))
+    rows = list(task_rows(tasks, fields, job))
+    # The types were worked out from every task's values, so the new values have to fit them too.
+    # Text columns fit anything
+    for row in rows:
+        if any(formats.widen(types[i], row[i]) != types[i] for i in range(1, len(fields))):
+            return None
+
+    hashes = dict(manifest["hashes"])
+    changed = []
+    for row in rows:
+        key = str(row[0])
+        if passes(row):
+            row = [row[i] for i in selected]
+            hashes[key] = row_hash(row)
+            if key not in manifest["hashes"]:
+                changed.append(["insert"] + row)
+            elif manifest["hashes"][key] != hashes[key]:
+                changed.append(["update"] + row)
+        elif key in hashes:
+            # Doesn't pass the filter anymore
+            changed.append(deleted_row(key, columns))
+            del hashes[key]
+    for task_id in changes["deleted"]["tasks"]:
+        if str(task_id) in hashes:
+            changed.append(deleted_row(str(task_id), columns))
+            del hashes[str(task_id)]
+
+    mode = request["mode"]
+    output, count = write_changes(format, path, mode, request, columns, column_types, changed)
+    write_manifest(path, {"revision": changes["revision"], "mode": mode, "settings": settings, "fields": fields,
+                          "field_types": types, "hashes": hashes})
+    if job is not None:
+        job.progress(len(tasks))
+    return {"code": 200, "message": "Exported", "data": {"mode": mode, "path": output, "rows": count}}
+
+
+def export_at(source: TaskSource, request: dict, job: Job = None, snapshot: bool = False) -> dict:
+    """Do an export, reading every page of tasks at one revision
+    :param source: The server
+    :param request: The export request, which has already been checked
+    :param job: The job doing the export, to report progress to
+    :param snapshot: True to get all of the tasks in one request, instead of a page at a time
+    :return: The response
+    :raises Moved: If the data changed while it was being read. Nothing has been written
+    """
+    format = request.get("format", "csv")
+    path = export_path(request)
+    mode = request.get("mode", "full")
+    manifest = read_manifest(path) if mode != "full" and os.path.exists(path) else None
+    if manifest is not None and not snapshot:
+        response = export_changes(source, request, manifest, job)
+        if response is not None:
+            return response
+
+    # CSV is written as it is stored, so the types are only needed to filter it
+    typed = format != "csv" or request.get("filter") is not None
+    if snapshot:
+        revision, attributes, snapshot_tasks = source.snapshot()
+        tasks = lambda fields=None: snapshot_tasks
+    else:
+        revision = source.revision()
+        attributes = source.attributes(revision)
+        tasks = lambda fields=None: source.tasks(revision, fields)
+    # Without the types, the first pass is only counting the tasks, so it only needs their IDs
+    fields, types, total = read_columns(attributes, tasks(None if typed else ["id"]), typed, job)
+    if job is not None:
+        job.progress(0, total)
+    columns = request.get("columns") or fields
+    try:
+        selected = [fields.index(column) for column in columns]
+        passes = row_filter(request.get("filter"), fields, types)
+    except (AttributeError, TypeError, ValueError):
+        return {"code": 400, "message": "Invalid Request", "data": None}
+    if mode != "full" and "ID" not in columns:
+        # The changes can't be matched up to the rows they replace without the ID
+        return {"code": 400, "message": "Invalid Request", "data": None}
+    column_types = [types[i] for i in selected]
+    settings = {"format": format, "columns": columns, "types": column_types, "filter": request.get("filter")}
+    if manifest is None or manifest["settings"] != settings:
+        mode = "full"
+    elif mode == "patch" and manifest.get("mode") == "delta":
+        # The manifest is from after the delta, but the file itself was never changed to match it
+        mode = "full"
+
+    hashes = {}
+
+    def rows():
+        """The selected values of each task that passes the filter, recording the hash of each"""
+        for row in task_rows(tasks(), fields, job):
+            if passes(row):
+                task_id = row[0]
+                row = [row[i] for i in selected]
+                hashes[str(task_id)] = row_hash(row)
+                yield row
+
+    if mode == "full":
+        output = path
+        count = write_file(format, path, columns, column_types, rows())
+    else:
+        # Only the rows that changed are kept, which is usually only a few
+        id_column = columns.index("ID")
+        changes = []
+        for row in rows():
+            key = str(row[id_column])
+            if key not in manifest["hashes"]:
+                changes.append(["insert"] + row)
+            elif manifest["hashes"][key] != hashes[key]:
+                changes.append(["update"] + row)
+        changes += [deleted_row(key, columns) for key in manifest["hashes"] if key not in hashes]
+        output, count = write_changes(format, path, mode, request, columns, column_types, changes)
+    write_manifest(path, {"revision": revision, "mode": mode, "settings": settings, "fields": fields,
+                          "field_types": types, "hashes": hashes})
+    if job is not None:
+        job.progress(total)
+    return {"code": 200, "message": "Exported", "data": {"mode": mode, "path": output, "rows": count}}
+
+
+def export(source: TaskSource, request: dict, job: Job = None) -> dict:
+    """Write the tasks to a file, with a column for each attribute in the catalogue.
+    The tasks are read from the server a page at a time, twice, once for the columns and once for the rows,
+    so they are never all in memory, and rows are written a group at a time. Every page is read at the same revision,
+    and if the data changes partway through, the export starts again, up to RETRIES times, after which all of
+    the tasks are got in one request instead.
+    A manifest is kept next to the file, with the revision and a hash of each row, so a later export can be
+    incremental. In delta mode, only the rows that were inserted, updated, or deleted since the last export to the path
+    are written, to a separate delta file, with a Change column first. In patch mode, the changes are made to the
+    last export itself instead, which works for CSV and JSON Lines. A delta doesn't change the last export, so a patch
+    after one is done as a full export. The changed tasks come from the server's change
+    feed when it goes back far enough, and otherwise every task is compared to the manifest.
+    Either way, if there is no manifest to compare to, or the columns or filter are different, a full export is done
+    :param source: The server
+    :param request: The format, the path to write to, and optionally which columns to write, a filter, the mode,
+    and for delta mode, the path to write the changes to
+    :param job: The job doing the export, to report progress to
+    :return: The response, with the mode that was used, the path, and the number of rows written
+    :raises jobs.Cancelled: If the job is cancelled. The last export and its manifest are left as they were
+    """
+    format = request.get("format", "csv")
+    if format not in formats.FORMATS:
+        return {"code": 415, "message": f"Unsupported format {format}", "data": None}
+    mode = request.get("mode", "full")
+    if mode not in MODES or (mode == "patch" and format not in ("csv", "jsonl")):
+        return {"code": 400, "message": "Invalid Request", "data": None}
+    for attempt in range(RETRIES + 1):
+        try:
+            return export_at(source, request, job, snapshot=attempt == RETRIES)
+        except Moved:
+            print("Data changed during export, starting again")
+    return {"code": 409, "message": "Conflict", "data": None}
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--workers', type=int, default=2,
+                    help='Number of exports that can run at the same time')
+parser.add_argument('--server', default=SERVER,
+                    help='Address of the task server to read the tasks from')
+parser.add_argument('--page-size', type=int, default=1000,
+                    help='Number of tasks to get from the server in each request')
+args = parser.parse_args()
 
 context = zmq.Context()
+source = TaskSource(context, args.server, args.workers, args.page_size)
+jobs = Jobs(lambda request, job: export(source, request, job), args.workers)
+
 socket = context.socket(zmq.REP)
 print("Starting Server")
 socket.bind("tcp://*:7777")
@@ -11,27 +491,48 @@ while True:
     #  Wait for next request from client
     message = str(socket.recv_string())
     print(f"Received request: {message}")
-    if message != "export":
+    # The plain "export" message still exports every column to ../data.csv
+    if message == "export":
+        request = {"type": "export", "format": "csv", "path": "../data.csv"}
+    else:
+        try:
+            request = json.loads(message)
+        except ValueError:
+            request = None
+    if not isinstance(request, dict):
         socket.send_string(json.dumps({"code": 400, "message": "Invalid Request", "data": None}))
         continue
 
-    with open("../data.csv", "w", newline="") as file:
-        writer = csv.writer(file)
-        with open("../microservice_B/data.json") as json_file:
-            data = json.load(json_file)
-            fields = ["ID", "Name", "Date", "Description"]
-            for attribute in data["attributes"]:
-                if attribute["name"] not in fields:
-                    fields.append(attribute["name"])
-            writer.writerow(fields)
-            for task in data["tasks"]:
-                row = [task["id"], task["name"], task["date"], task["description"]]
-                for attribute in data["attributes"]:
-                    value = ""
-                    for attr in task["attributes"]:
-                        if attr["name"] == attribute["name"]:
-                            value = attr["value"]
-                            break
-                    row.append(value)
-                writer.writerow(row)
-    socket.send_string(json.dumps({"code": 200, "message": "Exported", "data": None}))
\ No newline at end of file
+    # Exports run as jobs, so the reply is sent straight away with the job's ID,
+    # and the job is checked on with status and progress requests
+    try:
+        match request.get("type"):
+            case "export":
+                # Only one export writes to a file at a time, so a second click of the export button gets the first
+                busy = [job for job in jobs.active() if output_paths(job.request) & output_paths(request)]
+                if request.get("format", "csv") not in formats.FORMATS:
+                    response = {"code": 415, "message": f"Unsupported format {request['format']}", "data": None}
+                elif busy:
+                    response = {"code": 409, "message": "Already Exporting", "data": busy[0].status()}
+                else:
+                    response = {"code": 200, "message": "Started", "data": jobs.start(request).status()}
+            case "status" | "progress" | "cancel":
+                job = jobs.cancel(request.get("job")) if request["type"] == "cancel" else jobs.get(request.get("job"))
+                if job is None:
+                    response = {"code": 404, "message": "Not Found", "data": None}
+                elif request["type"] == "progress":
+                    status = job.status()
+                    response = {"code": 200, "message": "Progress",
+                                "data": {key: status[key] for key in ("job", "state", "done", "total", "progress")}}
+                else:
+                    response = {"code": 200, "message": request["type"].capitalize(), "data": job.status()}
+            case _:
+                response = {"code": 400, "message": "Invalid Request", "data": None}
+    except (AttributeError, KeyError, TypeError):
+        # Fields that are the wrong type, like a list as the job ID
+        response = {"code": 400, "message": "Invalid Request", "data": None}
+    except Exception as error:
+        # The client is still waiting for a reply, and the exporter has to carry on to answer the next request
+        print(f"Failed to answer {message}: {error!r}")
+        response = {"code": 500, "message": "Internal Server Error", "data": None}
+    socket.send_string(json.dumps(response))
@@ -0,0 +1,181 @@
+import csv
+import datetime
+import json
+import re
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+INTEGER = re.compile(r"-?\d{1,18}")  # Small enough for a 64 bit column
+NUMBER = re.compile(r"-?\d+(\.\d+)?")
+ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+US_DATE = re.compile(r"\d{1,2}/\d{1,2}/\d{4}")
+
+
+def parse_date(value: str) -> datetime.date | None:
+    """Read a date written as 2024-01-31 or 01/31/2024
+    :return: The date, or None if it isn't one
+    """
+    try:
+        if ISO_DATE.fullmatch(value):
+            return datetime.date.fromisoformat(value)
+        if US_DATE.fullmatch(value):
+            return datetime.datetime.strptime(value, "%m/%d/%Y").date()
+    except ValueError:
+        pass  # Looks like a date, but isn't a real day
+    return None
+
+
+def widen(column_type: str | None, value: str) -> str | None:
+    """Work out the type of a column, one value at a time
+    :param column_type: The type that fits the values so far, or None if there haven't been any
+    :param value: The next value. Empty values fit any type
+    :return: "int", "float", "date", or "string", whichever fits every value so far
+    """
+    if value == "" or column_type == "string":
+        return column_type
+    if INTEGER.fullmatch(value):
+        value_type = "int"
+    elif NUMBER.fullmatch(value):
+        value_type = "float"
+    elif parse_date(value) is not None:
+        value_type = "date"
+    else:
+        return "string"
+    if column_type is None or column_type == value_type:
+        return value_type
+    if {column_type, value_type} == {"int", "float"}:
+        return "float"
+    return "string"
+
+
+def convert(value, column_type: str):
+    """Turn a value, as it is stored, into the type of its column. Empty values are None, other than in text columns.
+    A value that is already that type stays the same
+    :raises ValueError: If it isn't that type
+    """
+    if value is None:
+        return None
+    if column_type == "string":
+        return str(value)
+    if value == "":
+        return None
+    match column_type:
+        case "int":
+            return int(value)
+        case "float":
+            return float(value)
+        case _:
+            if isinstance(value, datetime.date):
+                return value
+            date = parse_date(value)
+            if date is None:
+                raise ValueError(f"{value} isn't a date")
+            return date
+
+
+class CsvWriter:
+    """Writes rows as they are stored, like the export always has"""
+
+    def __init__(self, path: str, columns: list[str], types: list[str]):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, rows: list[list]):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlWriter:
+    """Writes each row as a JSON object on its own line, with numbers as numbers and dates as 2024-01-31"""
+
+    def __init__(self, path: str, columns: list[str], types: list[str]):
+        self.file = open(path, "w")
+        self.columns = columns
+        self.types = types
+
+    def write(self, rows: list[list]):
+        for row in rows:
+            values = {column: convert(value, column_type)
+                      for column, column_type, value in zip(self.columns, self.types, row)}
+            self.file.write(json.dumps(values, default=datetime.date.isoformat) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter:
+    """Writes an Arrow IPC file, with typed columns. Each call to write is one record batch"""
+
+    def __init__(self, path: str, columns: list[str], types: list[str]):
+        self.types = types
+        self.schema = pyarrow.schema([(column, ARROW_TYPES[column_type]) for column, column_type in zip(columns, types)])
+        self.writer = self.open(path)
+
+    def open(self, path: str):
+        return pyarrow.ipc.new_file(path, self.schema)
+
+    def batch(self, rows: list[list]):
+        """Turn rows into a record batch, a column at a time"""
+        arrays = [pyarrow.array([convert(row[i], column_type) for row in rows], type=ARROW_TYPES[column_type])
+                  for i, column_type in enumerate(self.types)]
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def write(self, rows: list[list]):
+        self.writer.write_batch(self.batch(rows))
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetWriter(ArrowWriter):
+    """Writes a Parquet file, with typed columns. Each call to write is one row group"""
+
+    def open(self, path: str):
+        return pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows: list[list]):
+        self.writer.write_table(pyarrow.Table.from_batches([self.batch(rows)]), row_group_size=len(rows))
+
+
+class XlsxWriter:
+    """Writes an Excel workbook with one sheet, with numbers and dates typed.
+    The workbook is write only, so rows go to disk as they are written instead of staying in memory
+    """
+
+    def __init__(self, path: str, columns: list[str], types: list[str]):
+        self.path = path
+        self.types = types
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet("Tasks")
+        self.sheet.append(columns)
+
+    def write(self, rows: list[list]):
+        for row in rows:
+            self.sheet.append([convert(value, column_type) for value, column_type in zip(row, self.types)])
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+# The formats that can be written, by name. The ones that need a package are only here if it is installed
+FORMATS = {"csv": CsvWriter, "jsonl": JsonlWriter}
+if pyarrow is not None:
+    ARROW_TYPES = {"int": pyarrow.int64(), "float": pyarrow.float64(), "date": pyarrow.date32(),
+                   "string": pyarrow.string()}
+    FORMATS["arrow"] = ArrowWriter
+    FORMATS["parquet"] = ParquetWriter
+if openpyxl is not None:
+    FORMATS["xlsx"] = XlsxWriter
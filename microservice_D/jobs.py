@@ -0,0 +1,115 @@
+import collections
+import itertools
+import queue
+import threading
+
+
+class Cancelled(Exception):
+    """Raised inside an export when its job has been cancelled"""
+
+
+class Job:
+    """An export that runs in the background, with how far along it is"""
+
+    def __init__(self, job_id: int, request: dict):
+        self.id = job_id
+        self.request = request
+        self.state = "queued"  # Then running, and then done, failed, or cancelled
+        self.done = 0  # Tasks gone through so far
+        self.total = None  # Tasks to go through, once it is known
+        self.result = None
+        self.error = None
+        self.cancelled = threading.Event()
+
+    def progress(self, done: int, total: int = None):
+        """Record how far along the export is
+        :raises Cancelled: If the job has been cancelled, so the export stops where it is
+        """
+        if self.cancelled.is_set():
+            raise Cancelled()
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    def status(self) -> dict:
+        """How the job is going, to send back to the client"""
+        return {"job": self.id, "state": self.state, "done": self.done, "total": self.total,
+                "progress": self.done / self.total if self.total else (1.0 if self.state == "done" else 0.0),
+                "result": self.result, "error": self.error}
+
+
+class Jobs:
+    """Runs exports on a pool of worker threads, so requests are answered straight away, several exports can
+    run at once, and a job can be checked on or cancelled while it runs.
+    Only the most recent finished jobs are kept.
+    """
+
+    def __init__(self, run, workers: int = 2, kept: int = 100):
+        """
+        :param run: Function that does an export, given its request and its job, and returns the response
+        :param workers: How many exports can run at once
+        :param kept: How many finished jobs to keep the status of
+        """
+        self.run = run
+        self.kept = kept
+        self.jobs: collections.OrderedDict[int, Job] = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.waiting = queue.Queue()
+        self.ids = itertools.count()
+        for i in range(workers):
+            threading.Thread(target=self.worker, name=f"export-{i}", daemon=True).start()
+
+    def start(self, request: dict) -> Job:
+        """Queue an export
+        :return: Its job
+        """
+        with self.lock:
+            job = Job(next(self.ids), request)
+            self.jobs[job.id] = job
+            finished = [old.id for old in self.jobs.values() if old.state in ("done", "failed", "cancelled")]
+            for job_id in finished[:max(0, len(finished) - self.kept)]:
+                del self.jobs[job_id]
+        self.waiting.put(job)
+        return job
+
+    def get(self, job_id: int) -> Job | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def active(self) -> list[Job]:
+        """Get the jobs that are queued or running"""
+        with self.lock:
+            return [job for job in self.jobs.values() if job.state in ("queued", "running")]
+
+    def cancel(self, job_id: int) -> Job | None:
+        """Stop a job. One that is still queued never runs, and one that is running stops at its next progress update
+        :return: The job, or None if there isn't one with that ID
+        """
+        job = self.get(job_id)
+        if job is not None:
+            job.cancelled.set()
+            if job.state == "queued":
+                job.state = "cancelled"
+        return job
+
+    def worker(self):
+        while True:
+            job = self.waiting.get()
+            if job.cancelled.is_set():
+                continue
+            job.state = "running"
+            try:
+                response = self.run(job.request, job)
+            except Cancelled:
+                job.state = "cancelled"
+                continue
+            except Exception as error:
+                job.error = str(error)
+                job.state = "failed"
+                continue
+            if response["code"] == 200:
+                job.result = response["data"]
+                job.state = "done"
+            else:
+                job.error = f"{response['code']} : {response['message']}"
+                job.state = "failed"
@@ -0,0 +1,85 @@
+# Copied into each microservice, which is run from its own directory. The copies are kept the same, see the README
+import queue
+import threading
+import zmq
+import wire
+
+
+class ConnectionPool:
+    """A set of REQ sockets to the server, so several requests can be waiting on it at once.
+    A REQ socket can only have one request out at a time, so each request takes a socket that isn't being used,
+    waiting for one to be put back if they all are.
+    """
+
+    def __init__(self, context: zmq.Context, address: str, size: int, encoding: str | None = None):
+        """
+        :param context: The context to make the sockets in
+        :param address: The address of the server
+        :param size: How many sockets to open
+        :param encoding: The encoding to send requests in, or None for plain JSON
+        """
+        self.encoding = encoding
+        self.idle = queue.Queue()
+        for _ in range(size):
+            socket = context.socket(zmq.REQ)
+            socket.connect(address)
+            self.idle.put(socket)
+
+    def request(self, message: dict) -> dict:
+        """Send a request to the server
+        :param message: The request, with a type, path, and data
+        :return: The response from the server
+        """
+        socket = self.idle.get()
+        try:
+            socket.send_multipart(wire.encode(message, self.encoding))
+            return wire.decode(socket.recv_multipart())[0]
+        finally:
+            self.idle.put(socket)
+
+
+class Coalescer:
+    """Shares the work of identical requests that are running at the same time. The first one to arrive does it,
+    and the rest wait for its result instead of doing it again.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running: dict[str, Coalescer.Call] = {}
+        self.shared = 0  # How many times a result was shared instead of worked out
+
+    def run(self, key: str, work):
+        """Do some work, or wait for the same work that is already being done
+        :param key: What the work is. Work with the same key has to have the same result
+        :param work: Function that does the work
+        :return: What work returned
+        :raises Exception: Whatever work raised
+        """
+        with self.lock:
+            call = self.running.get(key)
+            first = call is None
+            if first:
+                call = self.running[key] = self.Call()
+            else:
+                self.shared += 1
+        if not first:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = work()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.running[key]
+            call.done.set()
@@ -0,0 +1,100 @@
+from urllib.parse import urlencode
+import zmq
+import wire
+from pool import ConnectionPool
+
+
+class Moved(Exception):
+    """Raised when the server's data has changed since the revision it was being read at"""
+
+
+class ServerError(Exception):
+    """Raised when the server answers a request with an error"""
+
+
+class TaskSource:
+    """Reads the tasks through the server, instead of from its data file, so the export sees the same data as every
+    other client, including changes that haven't been saved yet, and works with any of the server's stores.
+    Every read is pinned to a revision. The server refuses it if the data has changed since, so an export never
+    mixes pages from before and after a change.
+    """
+
+    def __init__(self, context: zmq.Context, address: str, connections: int = 1, page_size: int = 1000):
+        """
+        :param context: The context to make the sockets in
+        :param address: The address of the server
+        :param connections: How many requests can be waiting on the server at once, which is how many exports
+        can read at the same time
+        :param page_size: How many tasks to get in each request
+        """
+        # msgpack is quicker to decode when it's installed, and pages are most of what an export does
+        self.pool = ConnectionPool(context, address, connections, "msgpack" if "msgpack" in wire.ENCODINGS else None)
+        self.page_size = page_size
+
+    def get(self, path: str) -> dict:
+        """Get something from the server
+        :param path: What to get, like tasks/all?limit=100
+        :return: The response
+        :raises Moved: If the request was pinned to a revision, and the data has changed since
+        :raises ServerError: If the server answered with any other error
+        """
+        response = self.pool.request({"type": "get", "path": path, "data": None})
+        if response["code"] == 409:
+            raise Moved()
+        if response["code"] != 200:
+            raise ServerError(f"get {path} : {response['code']} : {response['message']}")
+        return response
+
+    def revision(self) -> int:
+        """Get the revision the server's data is at now"""
+        return self.get("tasks/all?limit=0")["revision"]
+
+    def attributes(self, revision: int) -> list[dict]:
+        """Get the attribute catalogue, as it is at a revision
+        :raises Moved: If the data has changed since
+        """
+        return self.get(f"attributes/all?revision={revision}")["data"]
+
+    def tasks(self, revision: int, fields: list[str] = None):
+        """Go through the tasks as they are at a revision, a page at a time, in ID order
+        :param revision: The revision to read at
+        :param fields: The fields to get of each task, or None for all of them
+        :return: Generator of the tasks
+        :raises Moved: If the data changes before the last page has been read
+        """
+        cursor = None
+        while True:
+            params = {"limit": self.page_size, "revision": revision}
+            if cursor is not None:
+                params["cursor"] = cursor
+            if fields is not None:
+                params["fields"] = ",".join(fields)
+            response = self.get(f"tasks/all?{urlencode(params, safe=',')}")
+            yield from response["data"]
+            cursor = response["cursor"]
+            if cursor is None:
+                return
+
+    def snapshot(self) -> tuple[int, list[dict], list[dict]]:
+        """Get every task in one request, which the server answers all at once, so nothing can change partway through.
+        All of the tasks are in memory at once, so this is for when the data keeps changing while it is read in pages
+        :return: The revision, the attribute catalogue, and the tasks
+        :raises Moved: If the catalogue changes while the tasks are being got
+        """
+        # The catalogue is small, so it is got before and after instead of pinned, since other tasks changing
+        # doesn't change it
+        attributes = self.get("attributes/all")["data"]
+        response = self.get("tasks/all?offset=0")
+        if self.get("attributes/all")["data"] != attributes:
+            raise Moved()
+        return response["revision"], attributes, response["data"]
+
+    def changes(self, since: int) -> dict | None:
+        """Get what has changed since a revision, from the server's change feed
+        :return: The current revision, and the created and updated records and deleted IDs.
+        None if the server doesn't keep changes from that far back
+        """
+        response = self.pool.request({"type": "get", "path": f"changes?since={since}", "data": None})
+        if response["code"] != 200:
+            return None
+        return response["data"]
@@ -0,0 +1,40 @@
+# Copied into each microservice, which is run from its own directory. The copies are kept the same, see the README
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# How each encoding turns a message into bytes and back
+ENCODINGS = {
+    "json": (lambda message: json.dumps(message).encode(), json.loads),
+}
+if msgpack is not None:
+    ENCODINGS["msgpack"] = (msgpack.packb, msgpack.unpackb)
+
+
+def decode(frames: list[bytes]) -> tuple[dict, str | None]:
+    """Decode a message received from a socket. A single frame is plain JSON, like older clients send.
+    Two frames are the name of the encoding, followed by the message.
+    :param frames: The frames of the message
+    :return: The message, and the encoding named in its header (None for plain JSON)
+    :raises ValueError: If the encoding isn't one that is supported
+    """
+    if len(frames) == 1:
+        return json.loads(frames[0]), None
+    encoding = frames[0].decode()
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unsupported encoding {encoding}")
+    return ENCODINGS[encoding][1](frames[1]), encoding
+
+
+def encode(message, encoding: str | None) -> list[bytes]:
+    """Encode a message to send on a socket, the same way the request it answers was encoded
+    :param message: The message to encode
+    :param encoding: The encoding to use, or None for plain JSON with no header
+    :return: The frames to send
+    """
+    if encoding is None:
+        return [json.dumps(message).encode()]
+    return [encoding.encode(), ENCODINGS[encoding][0](message)]